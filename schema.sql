@@ -25,21 +25,29 @@ create table blogs(
     user_image varchar(500) not null,
     name varchar(50) not null,
     summary varchar(200) not null,
-    content mediumtext not null,
+    content mediumblob not null,
     created_at real not null,
+    comment_count bigint not null default 0,
+    version bigint not null default 0,
     key idx_created_at (created_at),
     primary key (id)
 ) engine=innodb, default character set=utf8;
 
+-- upgrade existing database, then run: python repair_counters.py
+-- alter table blogs add column comment_count bigint not null default 0;
+-- alter table blogs add column version bigint not null default 0;
+-- content columns are compressed by the ORM, run before deploying: python compress_columns.py --apply
+
 create table comments (
     id varchar(50) not null,
     blog_id varchar(50) not null,
     user_id varchar(50) not null,
     user_name varchar(50) not null,
     user_image varchar(500) not null,
-    content mediumtext not null,
+    content mediumblob not null,
     created_at real not null,
     key idx_created_at (created_at),
+    key idx_blog_id_created_at (blog_id, created_at),
     primary key (id)
 )engine=innodb, default character set=utf8;
 
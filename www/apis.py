@@ -11,6 +11,7 @@ __author__ = 'Liguo'
 
 import re, json, logging, functools
 from transwarp.web import ctx
+from transwarp.orm import CompactModel
 
 class Page(object):
     '''
@@ -68,13 +69,50 @@ class Page(object):
                 else (self.item_count - self.offset)
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        self.next_cursor = None
+        self.previous_cursor = None
         
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % \
             (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
             
     __repr__ = __str__
-    
+
+class CursorPage(Page):
+    '''
+    Page object for keyset pagination, which carries opaque cursors instead of page index.
+    '''
+
+    def __init__(self, page_size=10, next_cursor=None, previous_cursor=None):
+        '''
+        Init cursor page by page size and cursors returned by Model.find_page().
+
+        >>> p1 = CursorPage(10, 'Wzg1LCAiMDA3Il0', None)
+        >>> p1.has_next, p1.has_previous
+        (True, False)
+        >>> p1.limit
+        10
+        >>> p2 = CursorPage(10)
+        >>> p2.has_next, p2.has_previous
+        (False, False)
+        '''
+        self.item_count = None # unknown in cursor mode, no count query is needed.
+        self.page_size = page_size
+        self.page_count = None
+        self.page_index = None
+        self.offset = 0
+        self.limit = page_size
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.has_next = next_cursor is not None
+        self.has_previous = previous_cursor is not None
+
+    def __str__(self):
+        return 'page_size: %s, next_cursor: %s, previous_cursor: %s' % \
+            (self.page_size, self.next_cursor, self.previous_cursor)
+
+    __repr__ = __str__
+
 def _dump(obj):
     if isinstance(obj, Page):
         return {
@@ -82,8 +120,12 @@ def _dump(obj):
                 'page_count': obj.page_count,
                 'item_count': obj.item_count,
                 'has_next': obj.has_next,
-                'has_previous': obj.has_previous
+                'has_previous': obj.has_previous,
+                'next_cursor': obj.next_cursor,
+                'previous_cursor': obj.previous_cursor
         }
+    if isinstance(obj, CompactModel):
+        return obj.to_dict()
     raise TypeError('%s is not JSON serializable.' % obj)
 
 def dumps(obj):
@@ -115,6 +157,13 @@ class APIResourceNotFoundError(APIError):
     def __init__(self, field, message=''):
         super(APIResourceNotFoundError, self).__init__('Value:notfound', field, message)
         
+class APIConflictError(APIError):
+    '''
+    Indicate the resource was changed by others since it was loaded. The data specifies that resource name.
+    '''
+    def __init__(self, field, message=''):
+        super(APIConflictError, self).__init__('value:conflict', field, message)
+        
 class APIPermissionError(APIError):
     '''
     Indicate the API has no permission.
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Microbenchmark of dispatching requests over synthetic routes, by the Router of transwarp.web and by
+scanning route regexes in order like the application did before.
+
+usage: python bench_router.py [routes] [requests]
+'''
+
+__author__ = 'Liguo'
+
+import sys, time, random, logging
+
+from transwarp.web import get, post, Route, Router
+
+def _routes(n):
+    L = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            path = '/api/res%d' % i
+        elif kind == 1:
+            path = '/api/res%d/:id' % i
+        elif kind == 2:
+            path = '/api/res%d/:id/items/:item' % i
+        else:
+            path = '/res%d/:id-:page' % i
+        fn = (post if i % 8 == 1 else get)(path)(lambda *args: args)
+        L.append(Route(fn))
+    return L
+
+def _url(route):
+    return route.path.replace(':id', ':a0b1c2').replace(':item', ':d3e4').replace(':page', ':2')
+
+def _scan(routes):
+    static = dict([((r.method, r.path), r) for r in routes if r.is_static])
+    dynamic = [r for r in routes if not r.is_static]
+    def match(method, path):
+        r = static.get((method, path))
+        if r:
+            return r, ()
+        for r in dynamic:
+            if r.method == method:
+                args = r.match(path)
+                if args:
+                    return r, args
+        return None
+    return match
+
+def _bench(match, requests):
+    start = time.time()
+    for method, path in requests:
+        match(method, path)
+    return time.time() - start
+
+def main(argv):
+    n = int(argv[0]) if argv else 500
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    routes = _routes(n)
+    router = Router()
+    for r in routes:
+        router.add(r)
+    requests = [(r.method, _url(r)) for r in routes]
+    requests = [random.choice(requests) for i in range(count)]
+    for method, path in requests[:100]:
+        assert router.match(method, path) == _scan(routes)(method, path)
+    t_scan = _bench(_scan(routes), requests)
+    t_router = _bench(router.match, requests)
+    print '%d routes, %d requests:' % (n, count)
+    print '  scan:   %.3fs, %.1f us/request' % (t_scan, t_scan * 1e6 / count)
+    print '  router: %.3fs, %.1f us/request' % (t_router, t_router * 1e6 / count)
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Build static bundles of configs.assets, e.g. before deploying with assets.build off.
+
+usage: python build_assets.py
+'''
+
+__author__ = 'Liguo'
+
+import os, sys, logging
+
+from config import configs
+from transwarp import assets
+
+def main(argv):
+    document_root = os.path.dirname(os.path.abspath(__file__))
+    L = assets.build(document_root, configs.assets.bundles)
+    print 'Built %d of %d bundle(s).' % (len(L), len(configs.assets.bundles))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Compile all templates to a zip file, which is loaded by the template engine if configs.templates.bundle
+is set to it.
+
+usage: python compile_templates.py [target]
+'''
+
+__author__ = 'Liguo'
+
+import sys, logging
+
+from config import configs
+
+def main(argv):
+    target = argv[0] if argv else (configs.templates.bundle or 'templates.zip')
+    # the engine of the application has the filters used by templates:
+    import wsgiapp
+    wsgiapp.template_engine.compile_bundle(target)
+    print 'Templates compiled to %s.' % target
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
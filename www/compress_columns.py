@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Change columns of compressed fields to blob and compress the existing values. Run it before
+deploying code that writes compressed values, since they cannot be stored in a text column.
+
+usage: python compress_columns.py [--apply]
+
+Without --apply, only print the statements that would be executed.
+'''
+
+__author__ = 'Liguo'
+
+import sys, logging
+
+from config import configs
+from transwarp import db
+from models import User, Blog, Comment
+
+def main(argv):
+    apply = '--apply' in argv
+    db.create_engine(**configs.db)
+    for cls in (User, Blog, Comment):
+        names = [k for k in cls.__fields__ if cls.__mappings__[k].compress]
+        for k in names:
+            f = cls.__mappings__[k]
+            rows = db.select_rows('select data_type from information_schema.columns '
+                'where table_schema=database() and table_name=? and column_name=?', cls.__table__, k)
+            if rows and rows[0][0].lower().endswith('blob'):
+                continue
+            sql = 'alter table `%s` modify `%s` %s%s' % (cls.__table__, k, f.ddl, '' if f.nullable else ' not null')
+            print '%s;' % sql
+            if apply:
+                db.update(sql)
+        if names and apply:
+            print 'Compressed %d row(s) of %s.' % (cls.compress_rows(), cls.__table__)
+    if not apply:
+        print '-- dry run, use --apply to execute the statements above and compress existing rows.'
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
@@ -15,7 +15,69 @@ configs = {
           'password':'jlg234bob',
           'database':'awesomeweb'
     },
+    'server':{
+        'host':'127.0.0.1',
+        'port':9009,
+        # worker threads, 0 for the single-threaded development server with debug pages:
+        'threads':16,
+        # max connections waiting for a worker, more get 503:
+        'queue':128,
+        # seconds of waiting for next request of a connection, and for reading headers and body:
+        'keep_alive':5,
+        'header_timeout':10,
+        'body_timeout':30,
+        'max_body':10485760,
+        # worker processes forked by a supervisor, e.g. one per cpu core, 0 to serve in this process.
+        # SIGHUP reloads code without downtime:
+        'workers':0,
+        # recycle a worker after max_requests requests or when it uses max_rss MB, 0 for no limit:
+        'max_requests':0,
+        'max_rss':0,
+        # seconds of waiting for busy workers when stopping:
+        'graceful_timeout':30
+    },
+    'assets':{
+        # build bundles by build_assets.py before starting, or when application starts if True, which
+        # writes into static/ of the source tree. Missing bundles are always built at start:
+        'build':False,
+        # bundle => files, relative to document root. Css bundles stay in static/css/ for relative urls:
+        'bundles':{
+            'static/css/base.bundle.css':[
+                'static/css/uikit.min.css',
+                'static/css/uikit.gradient.min.css',
+                'static/css/awesome.css'
+            ],
+            'static/js/base.bundle.js':[
+                'static/js/jquery.min.js',
+                'static/js/md5.js',
+                'static/js/uikit.min.js',
+                'static/js/sticky.min.js',
+                'static/js/vue.min.js',
+                'static/js/awesome.js'
+            ]
+        }
+    },
+    'templates':{
+        # never check templates for changes and compile them all when starting, for deployment:
+        'production':False,
+        # directory to cache compiled templates, e.g. '/tmp/awesome-templates':
+        'cache_dir':'',
+        # compiled templates made by compile_templates.py, to be made again when templates change:
+        'bundle':''
+    },
     'session':{
         'secret':'AwEsOmE'
+    },
+    'queries':{
+        # a statement shape executed more than 'repeat' times in one request is a probable N+1 query:
+        'repeat':5,
+        # max statements of one request, and of the routes listed:
+        'budget':30,
+        'routes':{
+            '/':10,
+            '/blog/:blog_id':10
+        },
+        # raise instead of logging a warning, e.g. in tests:
+        'strict':False
     }
 }
\ No newline at end of file
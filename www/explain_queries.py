@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Check that statements issued by the app use indexes. The URLs are requested through the wsgi
+application while statements are sampled, then EXPLAIN is run for each statement shape against the
+database of configs, and full table scans, filesorts and temporary tables are reported by call site.
+
+usage: python explain_queries.py [--baseline=FILE] [--update-baseline] [url ...]
+
+Without urls, the home page, the first blog and the list APIs are requested. Exit with 1 if a
+statement shape has a problem that is not in the baseline, default to explain_baseline.json.
+'''
+
+__author__ = 'Liguo'
+
+import sys, os, json, logging
+from StringIO import StringIO
+
+from transwarp import db
+
+_EXPLAINABLE = ('select', 'update', 'delete')
+
+def _problems(plan):
+    '''
+    Return sorted problems of rows of EXPLAIN output.
+    '''
+    L = set()
+    for r in plan:
+        extra = r.get('Extra') or ''
+        if r.get('type') == 'ALL':
+            L.add('full scan of %s' % r.get('table'))
+        elif r.get('type') == 'index' and not 'Using index' in extra:
+            L.add('full index scan of %s' % r.get('table'))
+        if 'Using filesort' in extra:
+            L.add('filesort')
+        if 'Using temporary' in extra:
+            L.add('temporary table')
+    return sorted(L)
+
+def collect(app, urls):
+    '''
+    Request urls by the wsgi application, and return QueryStats with samples of the statements.
+    '''
+    with db.query_stats(samples=True) as stats:
+        for url in urls:
+            path, _, qs = url.partition('?')
+            env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': qs, 'wsgi.input': StringIO('')}
+            app(env, lambda status, headers: logging.info('%s: %s' % (url, status)))
+    return stats
+
+def explain(stats):
+    '''
+    Return dict of fingerprint and (call sites, problems) for each explainable statement shape.
+    '''
+    r = {}
+    for fp, (sql, args, sites) in stats.samples.iteritems():
+        if not fp.split(' ', 1)[0].lower() in _EXPLAINABLE:
+            continue
+        r[fp] = (sorted(sites), _problems(db.select('explain %s' % sql, *args)))
+    return r
+
+def main(argv):
+    baseline_file = 'explain_baseline.json'
+    update = False
+    urls = []
+    for arg in argv:
+        if arg.startswith('--baseline='):
+            baseline_file = arg[len('--baseline='):]
+        elif arg == '--update-baseline':
+            update = True
+        else:
+            urls.append(arg)
+    import wsgiapp
+    from models import Blog
+    if not urls:
+        urls = ['/', '/api/blogs', '/api/blogs?page=2', '/api/comments', '/api/users']
+        blog = Blog.query().order_by('created_at desc').first()
+        if blog:
+            urls.append('/blog/:%s' % blog.id)
+    report = explain(collect(wsgiapp.wsgi.get_wsgi_application(), urls))
+    baseline = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    regressions = 0
+    for fp in sorted(report):
+        sites, problems = report[fp]
+        new = [p for p in problems if not p in baseline.get(fp, ())]
+        regressions += len(new)
+        print '%s\n    %s' % (', '.join(sites) or '(unknown)', fp)
+        for p in problems:
+            print '    %s %s' % ('! NEW' if p in new else '-', p)
+    if update:
+        with open(baseline_file, 'w') as f:
+            json.dump(dict([(fp, problems) for fp, (sites, problems) in report.iteritems()]), f, indent=2, sort_keys=True)
+        print 'Baseline saved to %s.' % baseline_file
+        return 0
+    if regressions:
+        print '%d new problem(s) against %s.' % (regressions, baseline_file)
+        return 1
+    print 'No new problem in %d statement shape(s).' % len(report)
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
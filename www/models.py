@@ -8,13 +8,13 @@ Models for user, blog, comment.
 '''
 
 import time, uuid
-from transwarp.orm import Model, StringField, BooleanField, TextField, FloatField
+from transwarp.orm import CompactModel, StringField, BooleanField, TextField, FloatField, CounterField, VersionField
 from transwarp.db import next_id, create_engine, update
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
-class User(Model):
+class User(CompactModel):
 	'''
 	>>> u=User(name='jlg', email='jlg@gmail.com', password='jlg234876', admin=True)
 	>>> len(u.id)
@@ -24,16 +24,18 @@ class User(Model):
 	>>> u.delete()
 	'''
 	__table__ = 'users'
+	__counter__ = dict(reconcile=60)
+	__cache__ = dict(ttl=300, max_entries=1000)
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	name = StringField(ddl='varchar(50)')
 	password = StringField(ddl='varchar(50)')
-	email = StringField(updatable=False, ddl='varchar(50)')
+	email = StringField(updatable=False, ddl='varchar(50)', unique=True)
 	image = StringField(ddl='varchar(500)', default='no image')
 	admin = BooleanField()
-	created_at = FloatField(updatable=False, default=time.time)
+	created_at = FloatField(updatable=False, default=time.time, index=True)
 
-class Blog(Model):
+class Blog(CompactModel):
 	'''
 	>>> u=User(name='jlg', email='jlg@gmail.com', password='jlg234876', admin=True)
 	>>> b = Blog(name='python learn cast', user_id=u.id, user_name=u.name, 
@@ -45,17 +47,22 @@ class Blog(Model):
 	>>> b.delete()
 	'''
 	__table__ = 'blogs'
+	__counter__ = dict(reconcile=60)
+	# not cached: blogs are versioned and often written, and caches of other worker processes would
+	# serve stale version and comment_count until they expire.
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	user_id = StringField(updatable=False, ddl='varchar(50)')
-	user_name = StringField(ddl='varchar(50)')
-	user_image = StringField(ddl='varchar(500)')
+	user_id = StringField(updatable=False, ddl='varchar(50)', intern=True)
+	user_name = StringField(ddl='varchar(50)', intern=True)
+	user_image = StringField(ddl='varchar(500)', intern=True)
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
-	content = TextField()
-	created_at = FloatField(updatable=False, default=time.time)
+	content = TextField(compress=True, ddl='mediumblob')
+	created_at = FloatField(updatable=False, default=time.time, index=True)
+	comment_count = CounterField(model='Comment', key='blog_id')
+	version = VersionField()
 
-class Comment(Model):
+class Comment(CompactModel):
 	'''
 	>>> u=User(name='jlg', email='jlg@gmail.com', password='jlg234876', admin=True)
 	>>> b = Blog(name='python learn cast', user_id=u.id, user_name=u.name, 
@@ -69,14 +76,16 @@ class Comment(Model):
 	>>> c.delete()
 	'''
 	__table__ = 'comments'
+	__indexes__ = [('blog_id', 'created_at')]
+	__counter__ = dict(reconcile=60)
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	blog_id = StringField(updatable=False, ddl='varchar(50)')
-	user_id = StringField(updatable=False, ddl='varchar(50)')
-	user_name = StringField(ddl='varchar(50)')
-	user_image = StringField(ddl='varchar(500)')
-	content = TextField()
-	created_at = FloatField(updatable=False, default=time.time)
+	blog_id = StringField(updatable=False, ddl='varchar(50)', intern=True)
+	user_id = StringField(updatable=False, ddl='varchar(50)', intern=True)
+	user_name = StringField(ddl='varchar(50)', intern=True)
+	user_image = StringField(ddl='varchar(500)', intern=True)
+	content = TextField(compress=True, ddl='mediumblob')
+	created_at = FloatField(updatable=False, default=time.time, index=True)
 
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
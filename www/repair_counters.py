@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Recompute denormalized counters, e.g. Blog.comment_count, from the counted rows.
+
+usage: python repair_counters.py
+'''
+
+__author__ = 'Liguo'
+
+import sys, logging
+
+from config import configs
+from transwarp import db
+from models import Blog
+
+def main(argv):
+    db.create_engine(**configs.db)
+    with db.transaction():
+        n = Blog.repair_counters()
+    print 'Repaired %d blog(s).' % n
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
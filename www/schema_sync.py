@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+'''
+Add indexes declared by models but missing in database.
+
+usage: python schema_sync.py [--apply]
+
+Without --apply, only print the statements that would be executed.
+'''
+
+__author__ = 'Liguo'
+
+import sys, logging
+
+from config import configs
+from transwarp import db, orm
+from models import User, Blog, Comment
+
+def main(argv):
+    apply = '--apply' in argv
+    db.create_engine(**configs.db)
+    L = orm.sync_indexes([User, Blog, Comment], apply=apply)
+    if not L:
+        print 'All declared indexes exist.'
+        return 0
+    for sql in L:
+        print '%s;' % sql
+    if not apply:
+        print '-- dry run, use --apply to execute the statements above.'
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
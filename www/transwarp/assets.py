@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Static asset bundling: concatenate and minify javascript and css files into bundles with source maps.
+
+bundles = {
+    'static/js/base.bundle.js': ['static/js/jquery.min.js', 'static/js/awesome.js'],
+    'static/css/base.bundle.css': ['static/css/uikit.min.css', 'static/css/awesome.css']
+}
+build(document_root, bundles)
+
+Files named like *.min.js are minified already and only concatenated. Bundles are written only when
+their content changes, and served with content-hashed urls by static_url() of transwarp.web.
+'''
+
+__author__ = 'liguo'
+
+import os, re, json, logging
+
+_B64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def _vlq(n):
+    '''
+    Encode int as base64 VLQ of source map.
+
+    >>> _vlq(0), _vlq(1), _vlq(-1), _vlq(16)
+    ('A', 'C', 'D', 'gB')
+    '''
+    n = ((-n) << 1) | 1 if n < 0 else n << 1
+    s = ''
+    while True:
+        digit = n & 31
+        n >>= 5
+        if n:
+            digit |= 32
+        s += _B64[digit]
+        if not n:
+            return s
+
+def _mappings(L):
+    '''
+    Encode mappings of source map from list of (source index, source line) or None for each line.
+
+    >>> _mappings([(0, 0), (0, 1), None, (1, 0)])
+    'AAAA;AACA;;ACDA'
+    '''
+    segments = []
+    prev_source, prev_line = 0, 0
+    for m in L:
+        if m is None:
+            segments.append('')
+            continue
+        source, line = m
+        segments.append('A' + _vlq(source - prev_source) + _vlq(line - prev_line) + 'A')
+        prev_source, prev_line = source, line
+    return ';'.join(segments)
+
+def _split_lines(text):
+    '''
+    Return list of (line number, line) of non-blank lines.
+
+    >>> _split_lines('a\\n\\n  b\\n')
+    [(0, 'a'), (2, '  b')]
+    '''
+    return [(n, line) for n, line in enumerate(text.split('\n')) if line.strip()]
+
+# keywords after which '/' starts a regular expression:
+_RE_REGEX_KEYWORD = re.compile(r'(?:^|[^\w$])(?:return|typeof|case|do|else|in|instanceof|new|delete|void|throw)$')
+
+def minify_js(text):
+    '''
+    Remove comments, indents and blank lines of javascript but keep line breaks, so that no statement
+    depends on automatic semicolon insertion differently. Return list of (source line number, line).
+
+    >>> minify_js('// c\\nvar a = 1;   /* b */\\n\\n  if (a) {\\n    s = "// x" + /[/]*/g;\\n  }\\n')
+    [(1, 'var a = 1;'), (3, 'if (a) {'), (4, 's = "// x" + /[/]*/g;'), (5, '}')]
+    >>> minify_js('x = a / b / c;')
+    [(0, 'x = a / b / c;')]
+    '''
+    L = []
+    cur = []
+    state = dict(line=0, start=None)
+
+    def flush():
+        s = ''.join(cur).strip()
+        if s:
+            for k, sub in enumerate(s.split('\n')):
+                L.append((state['start'] + k, sub))
+        del cur[:]
+        state['start'] = None
+
+    def append(s):
+        if state['start'] is None:
+            state['start'] = state['line']
+        cur.append(s)
+
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if c == '\n':
+            flush()
+            state['line'] += 1
+            i += 1
+        elif c in ' \t\r\f\v':
+            if cur and cur[-1] != ' ':
+                cur.append(' ')
+            i += 1
+        elif text.startswith('//', i):
+            j = text.find('\n', i)
+            i = n if j == -1 else j
+        elif text.startswith('/*', i):
+            j = text.find('*/', i + 2)
+            j = n if j == -1 else j + 2
+            lines = text.count('\n', i, j)
+            if lines:
+                flush()
+                state['line'] += lines
+            elif cur and cur[-1] != ' ':
+                cur.append(' ')
+            i = j
+        elif c in '\'"`':
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == '\\' else 1
+            append(text[i:j + 1])
+            state['line'] += text.count('\n', i, j)
+            i = j + 1
+        elif c == '/' and _is_regex_start(''.join(cur).rstrip() or (L and L[-1][1] or '')):
+            j, in_class = i + 1, False
+            while j < n and text[j] != '\n' and (text[j] != '/' or in_class):
+                if text[j] == '\\':
+                    j += 1
+                elif text[j] == '[':
+                    in_class = True
+                elif text[j] == ']':
+                    in_class = False
+                j += 1
+            j += 1
+            while j < n and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            append(text[i:j])
+            i = j
+        else:
+            append(c)
+            i += 1
+    flush()
+    return L
+
+def _is_regex_start(before):
+    return not before or before[-1] in '(,=:[!&|?{};+-*%<>~^' or _RE_REGEX_KEYWORD.search(before) is not None
+
+_RE_CSS_TOKEN = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/)', re.S)
+_RE_CSS_SPACE = re.compile(r'\s*([{};,>])\s*')
+_RE_CSS_COLON = re.compile(r':\s+')
+
+def minify_css(text):
+    '''
+    Remove comments, indents, blank lines and spaces around punctuations of css, but keep line breaks.
+    Return list of (source line number, line).
+
+    >>> minify_css('/* c */\\nbody {\\n    color: red;\\n    content: "a , b";\\n}\\n')
+    [(1, 'body{'), (2, 'color:red;'), (3, 'content:"a , b";'), (4, '}')]
+    '''
+    def _token(m):
+        s = m.group(0)
+        # keep line breaks of comments to keep line numbers:
+        return '\n' * s.count('\n') if s.startswith('/*') else s
+    L = []
+    for n, line in _split_lines(_RE_CSS_TOKEN.sub(_token, text)):
+        parts = _RE_CSS_TOKEN.split(line)
+        for k in range(0, len(parts), 2):
+            parts[k] = _RE_CSS_COLON.sub(':', _RE_CSS_SPACE.sub(r'\1', re.sub(r'\s+', ' ', parts[k])))
+        s = ''.join(parts).strip()
+        if s:
+            L.append((n, s))
+    return L
+
+# source map comments of inputs point to wrong files in a bundle:
+_RE_SOURCE_MAP = re.compile(r'^\s*(?://|/\*)\s*[#@]\s*sourceMappingURL=')
+
+def bundle(document_root, output, inputs):
+    '''
+    Return (content, source map) of bundle concatenating inputs, paths are relative to document root.
+    '''
+    is_js = output.endswith('.js')
+    out_dir = os.path.dirname(output)
+    lines, mappings = [], []
+    for index, path in enumerate(inputs):
+        with open(os.path.join(document_root, path), 'rb') as f:
+            text = f.read()
+        if text.startswith('\xef\xbb\xbf'):
+            text = text[3:]
+        text = text.replace('\r\n', '\n')
+        if re.search(r'\.min\.(js|css)$', path):
+            pairs = _split_lines(text)
+        else:
+            pairs = minify_js(text) if is_js else minify_css(text)
+        for n, line in pairs:
+            if not _RE_SOURCE_MAP.match(line):
+                lines.append(line)
+                mappings.append((index, n))
+        if is_js:
+            # a file may end without semicolon:
+            lines.append(';')
+            mappings.append(None)
+    name = os.path.basename(output)
+    lines.append(('//# sourceMappingURL=%s.map' if is_js else '/*# sourceMappingURL=%s.map */') % name)
+    source_map = dict(version=3, file=name, names=[], mappings=_mappings(mappings),
+                      sources=[os.path.relpath(path, out_dir).replace(os.sep, '/') for path in inputs])
+    return '\n'.join(lines) + '\n', json.dumps(source_map, sort_keys=True)
+
+def _write(fpath, content):
+    if os.path.isfile(fpath):
+        with open(fpath, 'rb') as f:
+            if f.read() == content:
+                return False
+    with open(fpath, 'wb') as f:
+        f.write(content)
+    return True
+
+def build(document_root, bundles):
+    '''
+    Build bundles of {output: [inputs]} with source maps like output + '.map', paths are relative to
+    document root. Return list of outputs written.
+    '''
+    L = []
+    for output in sorted(bundles):
+        content, source_map = bundle(document_root, output, bundles[output])
+        changed = _write(os.path.join(document_root, output), content)
+        changed = _write(os.path.join(document_root, output + '.map'), source_map) or changed
+        if changed:
+            L.append(output)
+        logging.info('Bundle %s: %d files, %d bytes%s.' % (output, len(bundles[output]), len(content), '' if changed else ', not changed'))
+    return L
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -5,7 +5,7 @@
 Database operation module
 '''
 
-import time, uuid, functools, threading, logging
+import os, sys, time, uuid, functools, threading, logging, re
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -88,6 +88,9 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
 	pass
 
+class QueryBudgetError(DBError):
+	pass
+
 class _LazyConnection(object):
 	'''
 		Don't connect to DB until really use it.
@@ -105,12 +108,15 @@ class _LazyConnection(object):
 
 	def commit(self):
 		logging.info('***do commit in lazy connection!')
-		self.connection.commit()
+		# nothing to commit if no statement was executed:
+		if self.connection is not None:
+			self.connection.commit()
 
 	def rollback(self):
 		logging.info('***do rollback in lazy connection!')
-		logging.info('***connection.autocommit: %s' % self.connection.autocommit)
-		self.connection.rollback()
+		if self.connection is not None:
+			logging.info('***connection.autocommit: %s' % self.connection.autocommit)
+			self.connection.rollback()
 
 	def cleanup(self):
 		if self.connection:
@@ -126,6 +132,8 @@ class _DbCtx(threading.local):
 	def __init__(self):
 		self.connection = None
 		self.transactions = 0
+		self.commit_hooks = []
+		self.rollback_hooks = []
 
 	def is_init(self):
 		return not self.connection is None
@@ -133,6 +141,8 @@ class _DbCtx(threading.local):
 	def init(self):
 		self.connection = _LazyConnection()
 		self.transactions = 0
+		self.commit_hooks = []
+		self.rollback_hooks = []
 
 	def cleanup(self):
 		self.connection.cleanup()
@@ -263,13 +273,77 @@ class _TransactionCtx(object):
 			logging.warning('commit failed. try rollback.')
 			_db_ctx.connection.rollback()
 			logging.warning('rollback ok.')
+			_run_hooks(False)
 			raise
+		_run_hooks(True)
 
 	def rollback(self):
 		global _db_ctx
 		logging.warning('rollback transaction...')
-		_db_ctx.connection.rollback()
-		logging.info('rollback OK.')
+		try:
+			_db_ctx.connection.rollback()
+			logging.info('rollback OK.')
+		finally:
+			_run_hooks(False)
+
+def _run_hooks(committed):
+	'''
+	Run commit hooks if committed, otherwise rollback hooks, and drop both. A failed hook is logged
+	and does not stop the others, since the transaction is already finished.
+	'''
+	hooks = _db_ctx.commit_hooks if committed else _db_ctx.rollback_hooks
+	_db_ctx.commit_hooks = []
+	_db_ctx.rollback_hooks = []
+	for fn in hooks:
+		try:
+			fn()
+		except Exception, e:
+			logging.exception(e)
+
+def after_commit(fn):
+	'''
+	Call fn() after current transaction is committed, or immediately if not in transaction since
+	statements are auto committed. fn is dropped if the transaction is rolled back.
+
+	>>> L = []
+	>>> after_commit(lambda: L.append('now'))
+	>>> with transaction():
+	...     after_commit(lambda: L.append('committed'))
+	...     n = update('delete from user where id=?', '9999')
+	...     L.append('in transaction')
+	>>> try:
+	...     with transaction():
+	...         after_commit(lambda: L.append('never'))
+	...         n = update('delete from user where id=?', '9999')
+	...         raise StandardError('rollback')
+	... except StandardError:
+	...     pass
+	>>> L
+	['now', 'in transaction', 'committed']
+	'''
+	if _db_ctx.transactions == 0:
+		fn()
+	else:
+		_db_ctx.commit_hooks.append(fn)
+
+def after_rollback(fn):
+	'''
+	Call fn() after current transaction is rolled back. Do nothing if not in transaction.
+	'''
+	if _db_ctx.transactions > 0:
+		_db_ctx.rollback_hooks.append(fn)
+
+def in_transaction():
+	'''
+	Return True if current thread is in a transaction, whose changes are not visible to others yet.
+
+	>>> in_transaction()
+	False
+	>>> with transaction():
+	...     in_transaction()
+	True
+	'''
+	return _db_ctx.transactions > 0
 
 def transaction():
 	'''
@@ -319,6 +393,175 @@ def with_transaction(func):
 		_profiling(_start)
 	return _wrapper
 
+_RE_FP_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_RE_FP_NUMBER = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?')
+_RE_FP_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+_RE_FP_SPACE = re.compile(r'\s+')
+
+_fingerprints = {}
+
+def fingerprint(sql):
+	'''
+	Return shape of SQL statement, with literals replaced by '?' and lists of placeholders collapsed,
+	so statements that only differ in arguments have the same fingerprint.
+
+	>>> fingerprint("select * from `user` where id=%s and name='Bob' and age>30")
+	'select * from `user` where id=? and name=? and age>?'
+	>>> fingerprint('select * from idx_1 where id in (?,?,?) limit 10')
+	'select * from idx_1 where id in (...) limit ?'
+	>>> fingerprint('insert into t (a,b) values (?,?),(?,?)')
+	'insert into t (a,b) values (...)'
+	'''
+	fp = _fingerprints.get(sql)
+	if fp is None:
+		fp = _RE_FP_STRING.sub('?', sql.replace('%s', '?'))
+		fp = _RE_FP_NUMBER.sub('?', fp)
+		fp = _RE_FP_LIST.sub('(...)', fp)
+		fp = _RE_FP_SPACE.sub(' ', fp).strip()
+		if len(_fingerprints) >= 1000:
+			_fingerprints.clear()
+		_fingerprints[sql] = fp
+	return fp
+
+class QueryStats(object):
+	'''
+	Count and time of statements executed in current thread, grouped by fingerprint.
+
+	>>> stats = QueryStats()
+	>>> for i in range(3):
+	...     stats.record('select * from comments where blog_id=%s', 0.001)
+	>>> stats.record('select * from blogs limit 10', 0.002)
+	>>> stats.count
+	4
+	>>> stats.repeated(2)
+	[('select * from comments where blog_id=?', 3)]
+	>>> stats.check('/blog/:blog_id', repeat=2, budget=3, strict=True)
+	Traceback (most recent call last):
+	  ...
+	QueryBudgetError: /blog/:blog_id executed 4 statements, budget is 3.
+	'''
+	def __init__(self, samples=False):
+		self.count = 0
+		self.elapsed = 0.0
+		self.statements = {}
+		# fingerprint => (sql, args, set of call sites) if samples is True, for explaining statements:
+		self.samples = {} if samples else None
+		# stats of the outer with block, which counts the statements too:
+		self.outer = None
+
+	def record(self, sql, t):
+		fp = fingerprint(sql)
+		s = self.statements.get(fp)
+		if s is None:
+			self.statements[fp] = [1, t]
+		else:
+			s[0] += 1
+			s[1] += t
+		self.count += 1
+		self.elapsed += t
+
+	def sample(self, sql, args):
+		'''
+		Keep the first statement of each fingerprint with its arguments, and the call sites of it.
+		'''
+		fp = fingerprint(sql)
+		s = self.samples.get(fp)
+		if s is None:
+			s = self.samples[fp] = (sql, args, set())
+		site = _call_site()
+		if site:
+			s[2].add(site)
+
+	def repeated(self, repeat):
+		'''
+		Return list of (fingerprint, count) executed more than repeat times, most repeated first.
+		'''
+		L = [(fp, s[0]) for fp, s in self.statements.iteritems() if s[0] > repeat]
+		return sorted(L, key=lambda t: -t[1])
+
+	def check(self, name, repeat=5, budget=None, strict=False):
+		'''
+		Log statements repeated more than repeat times as probable N+1 queries, and statement count
+		above budget, of the request handled by name. Raise QueryBudgetError instead if strict.
+		'''
+		problems = ['%s executed %d times: probable N+1 query: %s' % (name, n, fp) for fp, n in self.repeated(repeat)]
+		if budget is not None and self.count > budget:
+			problems.append('%s executed %d statements, budget is %d.' % (name, self.count, budget))
+		for msg in problems:
+			logging.warning('[QUERIES] %s' % msg)
+		if strict and problems:
+			raise QueryBudgetError(problems[-1])
+
+	def summary(self):
+		'''
+		Return dict of total count and elapsed seconds, and statements ordered by count.
+		'''
+		L = [dict(sql=fp, count=s[0], elapsed=s[1]) for fp, s in self.statements.iteritems()]
+		L.sort(key=lambda d: -d['count'])
+		return dict(count=self.count, elapsed=self.elapsed, statements=L)
+
+class _QueryStatsCtx(threading.local):
+	def __init__(self):
+		self.stats = None
+
+# thread-local statistics of executed statements, None if not collecting:
+_stats_ctx = _QueryStatsCtx()
+
+class _CollectCtx(object):
+	'''
+	Collect statistics of statements executed in with block. Statements of nested blocks are counted by
+	the outer blocks too.
+	'''
+	def __init__(self, samples):
+		self.samples = samples
+
+	def __enter__(self):
+		self.stats = QueryStats(self.samples)
+		self.stats.outer = _stats_ctx.stats
+		_stats_ctx.stats = self.stats
+		return self.stats
+
+	def __exit__(self, exctype, excvalue, traceback):
+		_stats_ctx.stats = self.stats.outer
+
+def query_stats(samples=False):
+	'''
+	Return context object that collects QueryStats of current thread, with samples of statements and
+	their call sites if samples is True:
+
+	with query_stats() as stats:
+		handle_request()
+	stats.check('/api/blogs', budget=20)
+	'''
+	return _CollectCtx(samples)
+
+_TRANSWARP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _call_site():
+	'''
+	Return 'file:line function' of the nearest caller outside the transwarp package.
+	'''
+	f = sys._getframe(1)
+	while f is not None and os.path.dirname(os.path.abspath(f.f_code.co_filename)) == _TRANSWARP_DIR:
+		f = f.f_back
+	if f is None:
+		return None
+	return '%s:%d %s' % (os.path.basename(f.f_code.co_filename), f.f_lineno, f.f_code.co_name)
+
+def _execute(cursor, sql, args):
+	stats = _stats_ctx.stats
+	if stats is None:
+		cursor.execute(sql, args)
+		return
+	start = time.time()
+	cursor.execute(sql, args)
+	t = time.time() - start
+	while stats is not None:
+		stats.record(sql, t)
+		if stats.samples is not None:
+			stats.sample(sql, args)
+		stats = stats.outer
+
 @with_connection
 def _select(sql, first, *args):
 	'execute select SQL and return unique result or list results.'
@@ -328,7 +571,7 @@ def _select(sql, first, *args):
 	logging.info('SQL: %s, ARGS: %s' % (sql, args))
 	try:
 		cursor = _db_ctx.connection.cursor()
-		cursor.execute(sql, args)
+		_execute(cursor, sql, args)
 		if cursor.description:
 			names = [x[0] for x in cursor.description]
 			cursor.description
@@ -382,6 +625,35 @@ def select(sql, *args):
 	'''
 	return _select(sql, False, *args)
 
+@with_connection
+def _select_rows(sql, *args):
+	'execute select SQL and return rows as tuples in column order.'
+	global _db_ctx
+	cursor = None
+	sql = sql.replace('?', '%s')
+	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	try:
+		cursor = _db_ctx.connection.cursor()
+		_execute(cursor, sql, args)
+		return cursor.fetchall()
+	finally:
+		if cursor:
+			cursor.close()
+
+def select_rows(sql, *args):
+	'''
+	Execute select SQL and return list of tuples, or empty list if no result.
+	Values of each tuple are in the same order of the select columns, so the caller
+	can map them by position without building a dict for each row.
+
+	>>> select_rows("select id, name from user where id like '100%' order by id desc limit 2")
+	[(1009, u'Lily_9'), (1008, u'Lily_8')]
+	>>> select_rows('select id from user where 1>2')
+	[]
+	>>> 
+	'''
+	return _select_rows(sql, *args)
+
 @with_connection
 def _update(sql, *args):
 	global _db_ctx
@@ -390,7 +662,7 @@ def _update(sql, *args):
 	logging.info('SQL: %s, ARGS: %s' % (sql, args))
 	try:
 		cursor = _db_ctx.connection.cursor()
-		cursor.execute(sql, args)
+		_execute(cursor, sql, args)
 		r = cursor.rowcount
 		if _db_ctx.transactions == 0:
 			# no transaction enviroment:
@@ -7,7 +7,9 @@ __author__ = 'Liguo Jia'
 Database operation module, independent to web module.
 '''
 
-import time, logging
+import time, logging, re, json, base64, threading, Queue, struct, zlib
+from itertools import izip
+from collections import OrderedDict
 import db
 
 logging.basicConfig(level=logging.DEBUG)
@@ -23,6 +25,13 @@ class Field(object):
         self.updateable = kw.get('updateable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl', None)
+        # share equal values of low-cardinality column among loaded instances:
+        self.intern = kw.get('intern', False)
+        self.index = kw.get('index', False)
+        self.unique = kw.get('unique', False)
+        # store value of TextField or BlobField zlib compressed if it is long enough:
+        self.compress = kw.get('compress', False)
+        self.compress_threshold = kw.get('compress_threshold', 1024)
         self.order = Field._count
         Field._count += 1
 
@@ -77,7 +86,8 @@ class TextField(Field):
         if not 'default' in kw:
             kw['default'] = ''
         if not 'ddl' in kw:
-            kw['ddl'] = 'text'
+            # compressed value is binary:
+            kw['ddl'] = 'blob' if kw.get('compress') else 'text'
         super(TextField, self).__init__(**kw)
 
 class BlobField(Field):
@@ -88,14 +98,254 @@ class BlobField(Field):
             kw['ddl'] = 'blob'
         super(BlobField, self).__init__(**kw)
 
+class CounterField(IntegerField):
+    '''
+    Denormalized count of rows of another model that refer to this row, e.g.
+    comment_count = CounterField(model='Comment', key='blog_id') in Blog. The count is adjusted by
+    insert(), delete() and the bulk operations of the counted model in the same transaction, and is
+    never written by update() of its own model. Changing the key of an existing counted row by update()
+    is not tracked, so use repair_counters() to recompute the counts in bulk.
+    '''
+    def __init__(self, model, key, **kw):
+        kw['updateable'] = False
+        super(CounterField, self).__init__(**kw)
+        self.model = model
+        self.key = key
+
 class VersionField(Field):
+    '''
+    Version of row for optimistic concurrency. update() of the model only succeeds if the version in DB
+    is still the one loaded, increments it by the same statement, and raises ConflictError otherwise.
+    '''
     def __init__(self, name=None):
-        super(BlobField, self).__init__(name=name, default=0, ddl='bigint')
+        super(VersionField, self).__init__(name=name, default=0, ddl='bigint', updateable=False)
+
+class ConflictError(db.DBError):
+    '''
+    Raised by update() if the row was changed or deleted by others since it was loaded.
+    '''
+    pass
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+# counted model name => list of (counting model class, counter field name, key field name):
+_counters = {}
+
+_RE_WHERE = re.compile(r'^\s*where\s+', re.IGNORECASE)
+
+def _encode_cursor(values):
+    '''
+    Encode key values of a row as an opaque, url safe cursor string.
+
+    >>> c = _encode_cursor([1412909113.628, u'001'])
+    >>> _decode_cursor(c)
+    [1412909113.628, u'001']
+    '''
+    return base64.urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+def _decode_cursor(cursor):
+    '''
+    Decode cursor string made by _encode_cursor().
+
+    >>> _decode_cursor('bad cursor')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid cursor: bad cursor
+    '''
+    try:
+        s = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(s + '=' * (-len(s) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return values
+
+class _RowCounter(object):
+    '''
+    Cached row counts of a model, enabled by __counter__ = dict(reconcile=60) in model class.
+
+    The count of all rows is adjusted on insert() and delete() of current process, and reloaded from DB
+    when it is older than 'reconcile' seconds, so writes made by other processes or rolled back
+    transactions only make it approximate for a while. Counts of where clauses are cached the same way
+    but dropped on any insert or delete since we cannot tell if the row matches the where clause. At
+    most max_entries counts are kept, and the least recently used ones are dropped first.
+
+    >>> c = _RowCounter(reconcile=60)
+    >>> c.get('', lambda: 10)
+    10
+    >>> c.incr(2)
+    >>> c.get('', lambda: 10)
+    12
+    >>> c.get(('where id>?', (1,)), lambda: 5)
+    5
+    >>> c.incr(-1)
+    >>> c.get('', lambda: 10), c.get(('where id>?', (1,)), lambda: 4)
+    (11, 4)
+    >>> c.clear()
+    >>> c.get('', lambda: 10)
+    10
+    >>> c = _RowCounter(reconcile=60, max_entries=2)
+    >>> c.get('', lambda: 10), c.get(('where id>?', (1,)), lambda: 5), c.get(('where id>?', (2,)), lambda: 4)
+    (10, 5, 4)
+    >>> c.get('', lambda: 9)
+    9
+    '''
+    def __init__(self, reconcile=60, max_entries=1000):
+        self.reconcile = reconcile
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+
+    def get(self, key, fn_load):
+        with self._lock:
+            t = self._counts.pop(key, None)
+            if t and t[1] + self.reconcile > time.time():
+                # move to the most recently used end:
+                self._counts[key] = t
+                return t[0]
+        n = fn_load()
+        self.set(key, n)
+        return n
+
+    def set(self, key, n):
+        with self._lock:
+            self._counts.pop(key, None)
+            self._counts[key] = (n, time.time())
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def incr(self, delta):
+        with self._lock:
+            t = self._counts.get('')
+            self._counts.clear()
+            if t:
+                self._counts[''] = (t[0] + delta, t[1])
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+class _ModelCache(object):
+    '''
+    Second-level cache of model rows keyed by primary key, enabled by
+    __cache__ = dict(ttl=300, max_entries=1000) in model class.
+
+    Rows are kept as tuples of column values in LRU order and a new instance is built from the row on
+    each hit, so callers can modify the returned instance freely. Entries expire after ttl seconds, which bounds the staleness
+    caused by writes from other processes. Rows read in a transaction are not cached, and rows written
+    are evicted again after commit, so that only committed rows are cached.
+
+    >>> c = _ModelCache(ttl=300, max_entries=2)
+    >>> c.get('a')
+    >>> c.put('a', ('a', 'Bob'))
+    >>> c.put('b', ('b', 'Lily'))
+    >>> c.get('a')
+    ('a', 'Bob')
+    >>> c.put('c', ('c', 'Lucy'))
+    >>> c.get('b')
+    >>> c.evict('a')
+    >>> c.get('a')
+    >>> sorted(c.stats().items())
+    [('evictions', 1), ('hits', 1), ('max_entries', 2), ('misses', 3), ('size', 1), ('ttl', 300)]
+    '''
+    def __init__(self, ttl=300, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, pk):
+        with self._lock:
+            t = self._entries.pop(pk, None)
+            if t is None or t[0] < time.time():
+                self._misses += 1
+                return None
+            # move to the most recently used end:
+            self._entries[pk] = t
+            self._hits += 1
+            return t[1]
+
+    def put(self, pk, d):
+        with self._lock:
+            self._entries.pop(pk, None)
+            self._entries[pk] = (time.time() + self.ttl, d)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def evict(self, pk):
+        with self._lock:
+            self._entries.pop(pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate(self, pks=None):
+        '''
+        Evict rows of pks, or all rows if pks is None. Rows are evicted at once, so that the current
+        transaction reads its own writes, and again after it is committed, since other threads can cache
+        the old rows until then.
+        '''
+        if pks is None:
+            fn = self.clear
+        else:
+            pks = list(pks)
+            def fn():
+                for pk in pks:
+                    self.evict(pk)
+        fn()
+        if db.in_transaction():
+            db.after_commit(fn)
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self._hits, misses=self._misses, evictions=self._evictions,
+                size=len(self._entries), max_entries=self.max_entries, ttl=self.ttl)
+
+def _check_where(where):
+    '''
+    Make sure set-based update or delete has a where clause, so all rows cannot be touched by mistake.
+
+    >>> _check_where('where blog_id=?')
+    >>> _check_where('id=1')
+    Traceback (most recent call last):
+      ...
+    ValueError: Where clause must start with "where": id=1
+    '''
+    if not _RE_WHERE.match(where):
+        raise ValueError('Where clause must start with "where": %s' % where)
+
+def _keyset_clause(col, pk, op, value, pk_value):
+    '''
+    Return (sql, args) that selects rows after (value, pk_value) in the order of (col, pk). op is '>'
+    for ascending order and '<' for descending order.
+
+    >>> _keyset_clause('created_at', 'id', '<', 1.5, 'a')
+    ('(`created_at`<? or (`created_at`=? and `id`<?))', [1.5, 1.5, 'a'])
+    >>> _keyset_clause('id', 'id', '>', 'a', 'a')
+    ('`id`>?', ['a'])
+    '''
+    if col == pk:
+        return '`%s`%s?' % (pk, op), [pk_value]
+    return '(`%s`%s? or (`%s`=? and `%s`%s?))' % (col, op, col, pk, op), [value, value, pk_value]
 
-def _gen_sql(table_name, mappings):
+def _parse_order_by(cls, order_by):
+    '''
+    Parse order by clause like 'created_at desc' and return (field name, is desc).
+    '''
+    L = order_by.split()
+    if not L or len(L) > 2 or L[0] not in cls.__mappings__ or \
+            (len(L) == 2 and L[1].lower() not in ('asc', 'desc')):
+        raise ValueError('Invalid order by for keyset pagination: %s' % order_by)
+    return L[0], len(L) == 2 and L[1].lower() == 'desc'
+
+
+def _gen_sql(table_name, mappings, indexes=()):
     pk = None
     sql = ['-- generate SQL for %s: ' % table_name, 'create table if not exists `%s`(' % table_name]
     for f in sorted(mappings.itervalues(), lambda x, y: cmp(x.order, y.order)):
@@ -106,19 +356,698 @@ def _gen_sql(table_name, mappings):
         if f.primary_key:
             pk = f.name
         sql.append(nullable and '`%s` %s, ' % (f.name, f.ddl) or '`%s` %s not null, ' % (f.name, f.ddl))
-
+    for name, columns, unique in indexes:
+        sql.append(' %skey `%s` (%s), ' % ('unique ' if unique else '', name, ','.join(['`%s`' % c for c in columns])))
     sql.append(' primary key(`%s`)' % pk)
     sql.append(');')
     return '\n'.join(sql)
 
 
+class _InternPool(object):
+    '''
+    Pool of column values, so equal strings loaded from DB share one object. The pool stops growing
+    when max_size is reached, since the column is not low-cardinality as expected.
+
+    >>> p = _InternPool()
+    >>> a = p.intern(u'no image')
+    >>> p.intern(u'no ' + u'image') is a
+    True
+    '''
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._values = {}
+
+    def intern(self, value):
+        r = self._values.get(value)
+        if r is None:
+            if value is None or len(self._values) >= self.max_size:
+                return value
+            self._values[value] = r = value
+        return r
+
+_COMPRESSED = '\x00z'
+
+def _compress_value(f, v):
+    '''
+    Return value of compressed field to store: utf-8 bytes of text, zlib compressed and prefixed by a
+    marker if it is at least compress_threshold bytes and compression saves space.
+
+    >>> f = TextField(compress=True, compress_threshold=10)
+    >>> _compress_value(f, u'short')
+    'short'
+    >>> v = _compress_value(f, u'long ' * 100)
+    >>> v.startswith(_COMPRESSED), len(v) < 100
+    (True, True)
+    >>> _decompress_value(f, v) == u'long ' * 100
+    True
+    '''
+    if v is None:
+        return v
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    elif not isinstance(v, str):
+        v = str(v)
+    # a raw value starting with the marker is always compressed, so it is not mistaken when read:
+    if len(v) >= f.compress_threshold or v.startswith(_COMPRESSED):
+        c = _COMPRESSED + zlib.compress(v, 6)
+        if len(c) < len(v) or v.startswith(_COMPRESSED):
+            return c
+    return v
+
+def _decompress_value(f, v):
+    '''
+    Return value of compressed field loaded from DB, text of TextField is decoded as utf-8.
+    '''
+    if v is None:
+        return v
+    if isinstance(v, bytearray):
+        v = str(v)
+    if v.startswith(_COMPRESSED):
+        v = zlib.decompress(v[len(_COMPRESSED):])
+    if isinstance(v, str) and isinstance(f, TextField):
+        v = v.decode('utf-8')
+    return v
+
+class _Packed(object):
+    '''
+    Compressed value loaded from DB, kept in slot of CompactModel until it is accessed.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class _CompressedSlot(object):
+    '''
+    Descriptor of compressed field of CompactModel, which decompresses the loaded value on first access.
+    '''
+    def __init__(self, slot, field):
+        self.slot = slot
+        self.field = field
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        v = self.slot.__get__(obj, cls)
+        if type(v) is _Packed:
+            v = _decompress_value(self.field, v.value)
+            self.slot.__set__(obj, v)
+        return v
+
+    def __set__(self, obj, value):
+        self.slot.__set__(obj, value)
+
+    def __delete__(self, obj):
+        self.slot.__delete__(obj)
+
+def _column_decoder(cls, f):
+    '''
+    Return function that converts value of compressed field loaded from DB, or None if not compressed.
+    Values are decompressed at once for Model, and on first access for CompactModel.
+    '''
+    if not f.compress:
+        return None
+    if issubclass(cls, dict):
+        return lambda v: _decompress_value(f, v)
+    def _decode(v):
+        if isinstance(v, (str, bytearray)) and v[:len(_COMPRESSED)] == _COMPRESSED:
+            return _Packed(v)
+        return _decompress_value(f, v)
+    return _decode
+
+def _build_hydrator(cls, names):
+    '''
+    Return hydration function of model class for rows that select columns of names.
+    '''
+    pools = [cls.__pools__[cls.__fields__.index(k)] for k in names]
+    setters = None if issubclass(cls, dict) else [getattr(cls, k).__set__ for k in names]
+    decoders = [_column_decoder(cls, cls.__mappings__[k]) for k in names]
+    return _make_hydrator(names, pools, setters, decoders)
+
+def _make_hydrator(names, pools, setters=None, decoders=()):
+    '''
+    Return a function that builds model instances from row tuples whose values are in the order of names.
+    Values of pools that are not None are interned, values of decoders that are not None are converted
+    by them, and setters are slot descriptors of CompactModel.
+    '''
+    converts = [(i, p.intern) for i, p in enumerate(pools) if p is not None]
+    converts.extend([(i, fn) for i, fn in enumerate(decoders) if fn is not None])
+    def _hydrate(cls, rows):
+        new = cls.__new__
+        init = dict.__init__
+        L = []
+        for row in rows:
+            if converts:
+                row = list(row)
+                for i, fn in converts:
+                    row[i] = fn(row[i])
+            m = new(cls)
+            if setters is None:
+                init(m, izip(names, row))
+            else:
+                for fn_set, v in izip(setters, row):
+                    fn_set(m, v)
+            L.append(m)
+        return L
+    return _hydrate
+
+def _compile_model(table, mappings, primary_key):
+    '''
+    Precompute column order, SQL statements and hydration plan of a model, so ORM calls need
+    not to build them again and again.
+    '''
+    fields = sorted(mappings.iteritems(), key=lambda (k, f): f.order)
+    names = [k for k, f in fields]
+    pk = primary_key.name
+    insert_fields = [(k, f) for k, f in fields if f.insertable]
+    update_fields = [(k, f) for k, f in fields if f.updateable and not f.primary_key]
+    versions = [k for k, f in fields if isinstance(f, VersionField)]
+    if len(versions) > 1:
+        raise TypeError('Cannot define more than 1 version field in table %s' % table)
+    version = versions[0] if versions else None
+    sets = ['`%s`=?' % k for k, f in update_fields]
+    where = '`%s`=?' % pk
+    if version:
+        sets.append('`%s`=`%s`+1' % (version, version))
+        where = '%s and `%s`=?' % (where, version)
+    select = 'select %s from `%s`' % (','.join(['`%s`' % k for k in names]), table)
+    return {
+        '__fields__': names,
+        '__insert_fields__': insert_fields,
+        '__update_fields__': update_fields,
+        '__version__': version,
+        '__insert_names__': tuple([k for k, f in insert_fields]),
+        # positions of compressed fields in insert and update arguments:
+        '__insert_packers__': [(i, f) for i, (k, f) in enumerate(insert_fields) if f.compress],
+        '__update_packers__': [(i, f) for i, (k, f) in enumerate(update_fields) if f.compress],
+        '__update_names__': tuple([k for k, f in update_fields] + (version and [version] or [])),
+        '__columns_sql__': ','.join(['`%s`' % k for k in names]),
+        '__select_sql__': select,
+        '__get_sql__': '%s where `%s`=?' % (select, pk),
+        '__insert_sql__': 'insert into `%s` (%s) values (%s)' % (table,
+            ','.join(['`%s`' % k for k, f in insert_fields]), ','.join(['?'] * len(insert_fields))),
+        '__update_sql__': 'update `%s` set %s where %s' % (table, ','.join(sets), where),
+        '__delete_sql__': 'delete from `%s` where `%s`=?' % (table, pk),
+        '__count_sql__': 'select count(`%s`) from `%s`' % (pk, table),
+        '__pools__': [_InternPool() if f.intern else None for k, f in fields],
+    }
+
+def _codec_kind(f):
+    '''
+    Return struct format of fixed size field, or 'text' or 'bytes' for variable size field.
+    '''
+    if isinstance(f, (IntegerField, VersionField)):
+        return 'q'
+    if isinstance(f, FloatField):
+        return 'd'
+    if isinstance(f, BooleanField):
+        return '?'
+    if isinstance(f, (StringField, TextField)):
+        return 'text'
+    if isinstance(f, BlobField):
+        return 'bytes'
+    ddl = (f.ddl or '').lower()
+    if 'int' in ddl:
+        return 'q'
+    if ddl.startswith(('real', 'float', 'double')):
+        return 'd'
+    if ddl.startswith('bool'):
+        return '?'
+    return 'bytes' if 'blob' in ddl or 'binary' in ddl else 'text'
+
+def _with_nulls(row, bitmap):
+    return tuple([None if bitmap & (1 << i) else v for i, v in enumerate(row)])
+
+class _Codec(object):
+    '''
+    Binary codec of model rows generated from __mappings__. An encoded row is a head packed by one struct,
+    holding bitmap of None values, lengths of variable size fields and values of fixed size fields, and
+    the bytes of variable size fields that follow. Data starts with the kind ('O' for one instance and
+    'L' for list) and a tag of field names and types, so data encoded by another version of the model
+    is rejected instead of decoded wrongly. In a list, a repeated value of Field(intern=True) is stored
+    once and referred by index later.
+
+    >>> class Note(Model):
+    ...     id = IntegerField(primary_key=True)
+    ...     title = StringField()
+    ...     score = FloatField(nullable=True)
+    ...     done = BooleanField()
+    ...
+    >>> data = Note(id=1, title=u'\\u4f60\\u597d', score=None, done=True).encode()
+    >>> len(data)
+    33
+    >>> n = Note.decode(data)
+    >>> n.id, n.title, n.score, n.done
+    (1, u'\\u4f60\\u597d', None, True)
+    >>> L = Note.decode_many(Note.encode_many([Note(id=i, title='t%d' % i) for i in range(3)]))
+    >>> [(n.id, n.title) for n in L]
+    [(0, u't0'), (1, u't1'), (2, u't2')]
+    >>> Note.decode(Note.encode_many([]))
+    Traceback (most recent call last):
+      ...
+    ValueError: Data is not encoded by current version of Note.
+    '''
+    _prefix = struct.Struct('<cI')
+    _count = struct.Struct('<I')
+    _REF = 0x80000000
+
+    def __init__(self, cls):
+        self.cls = cls
+        names = cls.__fields__
+        if len(names) > 64:
+            raise TypeError('Cannot encode model with more than 64 fields: %s' % cls.__name__)
+        fields = [cls.__mappings__[k] for k in names]
+        kinds = [_codec_kind(f) for f in fields]
+        self.tag = zlib.crc32(repr(zip(names, kinds))) & 0xffffffff
+        fixed = [i for i, kind in enumerate(kinds) if len(kind) == 1]
+        var = [i for i, kind in enumerate(kinds) if len(kind) > 1]
+        bitmap = 'B' if len(names) <= 8 else 'H' if len(names) <= 16 else 'I' if len(names) <= 32 else 'Q'
+        head = struct.Struct('<%s%s%s' % (bitmap, 'I' * len(var), ''.join([kinds[i] for i in fixed])))
+        scope = dict(pack=head.pack, unpack_from=head.unpack_from, size=head.size, defaults=fields,
+            unicode=unicode, str=str, REF=self._REF, _with_nulls=_with_nulls)
+        heads = ['l%d' % i for i in var] + ['v%d' % i for i in fixed]
+        # generate encoder and decoder of the model, so no loop over fields is run for each row:
+        src = ['def encode_rows(instances, L, refs):', '    for m in instances:', '        nulls = 0', '        chunks = []']
+        for i, k in enumerate(names):
+            src.append('        if not %r in m: m[%r] = defaults[%d].default' % (k, k, i))
+            src.append('        v%d = m[%r]' % (i, k))
+            src.append('        if v%d is None: nulls |= %d' % (i, 1 << i))
+        for i in var:
+            src.append('        if v%d is None: s = ""' % i)
+            if kinds[i] == 'text':
+                src.append('        elif type(v%d) is unicode: s = v%d.encode("utf-8")' % (i, i))
+            src.append('        else: s = str(v%d)' % i)
+            if fields[i].intern:
+                src.append('        r = refs.get(s) if refs is not None else None')
+                src.append('        if r is None:')
+                src.append('            if refs is not None: refs[s] = len(refs)')
+                src.append('            l%d = len(s)' % i)
+                src.append('            chunks.append(s)')
+                src.append('        else: l%d = r | REF' % i)
+            else:
+                src.append('        l%d = len(s)' % i)
+                src.append('        chunks.append(s)')
+        for i in fixed:
+            src.append('        if v%d is None: v%d = 0' % (i, i))
+        src.append('        L.append(pack(%s))' % ', '.join(['nulls'] + heads))
+        src.append('        L.extend(chunks)')
+        src.extend(['def decode_rows(data, pos, count, refs):', '    rows = []', '    for x in xrange(count):',
+            '        (%s,) = unpack_from(data, pos)' % ', '.join(['nulls'] + heads), '        pos += size'])
+        for i in var:
+            indent = '        '
+            if fields[i].intern:
+                src.append('        if l%d & REF: v%d = refs[l%d ^ REF]' % (i, i, i))
+                src.append('        else:')
+                indent = '            '
+            src.append('%se = pos + l%d' % (indent, i))
+            src.append('%sv%d = data[pos:e]%s' % (indent, i, '.decode("utf-8")' if kinds[i] == 'text' else ''))
+            src.append('%spos = e' % indent)
+            if fields[i].intern:
+                src.append('            refs.append(v%d)' % i)
+        src.append('        row = (%s,)' % ', '.join(['v%d' % i for i in range(len(names))]))
+        src.append('        rows.append(_with_nulls(row, nulls) if nulls else row)')
+        src.append('    return rows, pos')
+        exec '\n'.join(src) in scope
+        self._encode_rows = scope['encode_rows']
+        self._decode_rows = scope['decode_rows']
+
+    def encode(self, instances, many):
+        L = [self._prefix.pack('L' if many else 'O', self.tag)]
+        if many:
+            L.append(self._count.pack(len(instances)))
+        self._encode_rows(instances, L, {} if many else None)
+        return ''.join(L)
+
+    def decode(self, data, many):
+        try:
+            kind, tag = self._prefix.unpack_from(data, 0)
+            if kind != ('L' if many else 'O') or tag != self.tag:
+                raise ValueError('Data is not encoded by current version of %s.' % self.cls.__name__)
+            pos = self._prefix.size
+            count = 1
+            if many:
+                count = self._count.unpack_from(data, pos)[0]
+                pos += self._count.size
+            rows, pos = self._decode_rows(data, pos, count, [])
+        except (struct.error, UnicodeError, IndexError):
+            raise ValueError('Invalid data of %s.' % self.cls.__name__)
+        if pos != len(data):
+            raise ValueError('Invalid data of %s.' % self.cls.__name__)
+        return self.cls._hydrate(rows)
+
+def _multi_values(insert_sql, rows):
+    '''
+    Extend single row insert SQL to multi-row insert. Return (sql, flat params).
+
+    >>> _multi_values('insert into `t` (`a`,`b`) values (?,?)', [[1, 2], [3, 4]])
+    ('insert into `t` (`a`,`b`) values (?,?),(?,?)', [1, 2, 3, 4])
+    '''
+    pos = insert_sql.rindex(' values ') + len(' values ')
+    placeholder = insert_sql[pos:]
+    params = []
+    for row in rows:
+        params.extend(row)
+    return '%s%s' % (insert_sql[:pos], ','.join([placeholder] * len(rows))), params
+
+def _hooked_values(cls, values):
+    '''
+    Call pre_update() on a transient instance built from values, and return values with the fields
+    assigned by pre_update() added. Fields only read by pre_update() are not included.
+    '''
+    m = cls(**values)
+    defaults = {}
+    for k, f in cls.__mappings__.iteritems():
+        if not k in m:
+            m[k] = defaults[k] = f.default
+    m.pre_update()
+    r = dict(values)
+    for k, v in m.iteritems():
+        if not k in r and (not k in defaults or v is not defaults[k]):
+            r[k] = v
+    return r
+
+def _build_indexes(mappings, declared):
+    '''
+    Collect indexes from Field(index=True), Field(unique=True) and __indexes__ of model, and return
+    list of (name, columns, unique). Item of __indexes__ is tuple of columns, or dict like
+    dict(columns=('a', 'b'), unique=True, name='idx_ab').
+
+    >>> _build_indexes(dict(id=Field(primary_key=True), email=Field(unique=True), blog_id=Field()),
+    ...     [('blog_id', 'email'), dict(columns=('blog_id',), name='idx_blog')])
+    [('idx_email', ('email',), True), ('idx_blog_id_email', ('blog_id', 'email'), False), ('idx_blog', ('blog_id',), False)]
+    '''
+    L = []
+    for k, f in sorted(mappings.iteritems(), key=lambda (k, f): f.order):
+        if (f.index or f.unique) and not f.primary_key:
+            L.append(('idx_%s' % k, (k,), bool(f.unique)))
+    for d in declared:
+        if not isinstance(d, dict):
+            d = dict(columns=d)
+        columns = tuple(d['columns'])
+        for c in columns:
+            if not c in mappings:
+                raise TypeError('Index column "%s" is not a field.' % c)
+        L.append((d.get('name') or 'idx_%s' % '_'.join(columns), columns, bool(d.get('unique'))))
+    return L
+
+def sync_indexes(models, apply=False):
+    '''
+    Compare indexes declared by models with information_schema of current database, and return the
+    'alter table' statements that add missing indexes. The statements are executed if apply is True.
+    An existing index covers the declared one if its leading columns are the same, and indexes that
+    exist only in database are never dropped.
+
+    The statements use algorithm=inplace and lock=none, so tables stay readable and writable.
+    '''
+    L = []
+    for cls in models:
+        existing = {}
+        for name, non_unique, column in db.select_rows('select index_name, non_unique, column_name from information_schema.statistics '
+                'where table_schema=database() and table_name=? order by index_name, seq_in_index', cls.__table__):
+            existing.setdefault(name, [not non_unique, []])[1].append(column)
+        for name, columns, unique in cls.__indexes__:
+            covered = False
+            for is_unique, cols in existing.itervalues():
+                if tuple(cols[:len(columns)]) == columns and (is_unique or not unique) \
+                        and (not unique or len(cols) == len(columns)):
+                    covered = True
+                    break
+            if covered:
+                continue
+            sql = 'alter table `%s` add %sindex `%s` (%s), algorithm=inplace, lock=none' % (cls.__table__,
+                'unique ' if unique else '', name, ','.join(['`%s`' % c for c in columns]))
+            if apply:
+                logging.info('Add index: %s' % sql)
+                db.update(sql)
+            L.append(sql)
+    return L
+
+def _register_counters(klass):
+    '''
+    Register CounterField of model class, replacing counters of a model class with the same name.
+    '''
+    for L in _counters.itervalues():
+        L[:] = [t for t in L if t[0].__name__ != klass.__name__]
+    for k, f in klass.__mappings__.iteritems():
+        if isinstance(f, CounterField):
+            _counters.setdefault(f.model, []).append((klass, k, f.key))
+
+def _counter_deltas(cls, instances, delta):
+    '''
+    Return list of (counting model, counter field name, dict of key value and delta) for instances of
+    counted model cls, each adding delta to the counter of the row it refers to.
+    '''
+    L = []
+    for klass, name, key in _counters.get(cls.__name__, ()):
+        deltas = {}
+        for m in instances:
+            v = m[key]
+            if v is not None:
+                deltas[v] = deltas.get(v, 0) + delta
+        L.append((klass, name, deltas))
+    return L
+
+def _deleted_counter_deltas(cls, where, args):
+    '''
+    Like _counter_deltas(), but for rows of cls that are going to be deleted by the where clause. The rows
+    are locked so the counts cannot change before they are deleted.
+    '''
+    L = []
+    for klass, name, key in _counters.get(cls.__name__, ()):
+        rows = db.select_rows('select `%s`,count(*) from `%s` %s group by `%s` for update' % (key, cls.__table__, where, key), *args)
+        L.append((klass, name, dict([(v, -n) for v, n in rows if v is not None])))
+    return L
+
+def _apply_counter_deltas(changes):
+    '''
+    Update counters by changes returned from _counter_deltas(), by one statement for all keys with the
+    same delta. Must be called in the transaction that changes the counted rows.
+    '''
+    for klass, name, deltas in changes:
+        keys = {}
+        for v, d in deltas.iteritems():
+            if d:
+                keys.setdefault(d, []).append(v)
+        for d, L in keys.iteritems():
+            db.update('update `%s` set `%s`=`%s`+? where `%s` in (%s)' % (klass.__table__, name, name,
+                klass.__primary_key__.name, ','.join(['?'] * len(L))), d, *L)
+            _publish('post_update', klass, L, (name,))
+
+def _evict_counters(changes):
+    '''
+    Evict cached rows whose counters are changed, at once and again after the outermost transaction
+    is committed.
+    '''
+    for klass, name, deltas in changes:
+        if klass.__cache__ is not None:
+            klass.__cache__.invalidate(deltas)
+
+def _recount(klass, name, keys=None):
+    '''
+    Recompute counter field of model class by one statement, for rows of primary keys in keys or all rows.
+    Return changed row count.
+    '''
+    f = klass.__mappings__[name]
+    counted = ModelMetaclass.subclass.get(f.model)
+    if not isinstance(counted, type):
+        raise TypeError('Counted model "%s" of %s.%s is not defined.' % (f.model, klass.__name__, name))
+    pk = klass.__primary_key__.name
+    sql = 'update `%s` set `%s`=(select count(*) from `%s` where `%s`.`%s`=`%s`.`%s`)' % (klass.__table__, name,
+        counted.__table__, counted.__table__, f.key, klass.__table__, pk)
+    if keys is None:
+        return db.update(sql)
+    keys = list(keys)
+    if not keys:
+        return 0
+    return db.update('%s where `%s` in (%s)' % (sql, pk, ','.join(['?'] * len(keys))), *keys)
+
+_events = ('post_insert', 'post_update', 'post_delete')
+
+# event name => list of _Subscriber:
+_subscribers = dict([(e, []) for e in _events])
+
+class ModelEvent(object):
+    '''
+    A committed change of model row: event name, model class, primary key and names of changed fields.
+    Fields of post_delete event is empty.
+    '''
+    __slots__ = ('name', 'model', 'pk', 'fields')
+
+    def __init__(self, name, model, pk, fields):
+        self.name = name
+        self.model = model
+        self.pk = pk
+        self.fields = fields
+
+    def __repr__(self):
+        return '<ModelEvent %s %s %s%s>' % (self.name, self.model.__name__, self.pk,
+            ''.join([' ' + ','.join(self.fields)] if self.fields else []))
+
+class _Subscriber(object):
+    __slots__ = ('fn', 'model', 'batch', 'background')
+
+    def __init__(self, fn, model, batch, background):
+        self.fn = fn
+        self.model = model
+        self.batch = batch
+        self.background = background
+
+    def wants(self, cls):
+        return self.model is None or self.model == cls.__name__
+
+def subscribe(event, fn, model=None, batch=False, background=False):
+    '''
+    Subscribe fn to model events, which are delivered after the transaction of the change is committed,
+    or right after the change if not in transaction. Events of rolled back transactions are dropped.
+
+    Args:
+        event: 'post_insert', 'post_update' or 'post_delete'
+        fn: function that accepts a ModelEvent, or a list of ModelEvent if batch is True
+        model: model class or class name, default to all models
+        batch: call fn once for all matched events of a transaction
+        background: call fn in a background thread so the writer does not wait for it
+
+    >>> class Tag(Model):
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...
+    >>> n = db.update('drop table if exists tag')
+    >>> Tag.create_table()
+    >>> def on_change(e):
+    ...     print e
+    >>> subscribe('post_insert', on_change, model=Tag)
+    >>> subscribe('post_update', on_change, model=Tag)
+    >>> t = Tag(id=1, name='python').insert()
+    <ModelEvent post_insert Tag 1 id,name>
+    >>> with db.transaction():
+    ...     t.name = 'py'
+    ...     t = t.update()
+    ...     print 'not committed yet'
+    not committed yet
+    <ModelEvent post_update Tag 1 name>
+    >>> unsubscribe('post_insert', on_change)
+    >>> unsubscribe('post_update', on_change)
+    '''
+    if not event in _subscribers:
+        raise ValueError('Invalid event: %s' % event)
+    if isinstance(model, type):
+        model = model.__name__
+    _subscribers[event].append(_Subscriber(fn, model, batch, background))
+
+def unsubscribe(event, fn):
+    '''
+    Remove fn from subscribers of event.
+    '''
+    _subscribers[event][:] = [s for s in _subscribers.get(event, ()) if s.fn is not fn]
+
+class _EventsCtx(threading.local):
+    def __init__(self):
+        # events of current transaction, None if not in transaction or no event yet:
+        self.pending = None
+
+_events_ctx = _EventsCtx()
+
+def _subscribed(name, cls):
+    for s in _subscribers[name]:
+        if s.wants(cls):
+            return True
+    return False
+
+def _publish(name, cls, pks, fields):
+    '''
+    Queue events of changed rows, to be dispatched after the current transaction is committed.
+    '''
+    if not _subscribed(name, cls):
+        return
+    events = [ModelEvent(name, cls, pk, fields) for pk in pks]
+    if not events:
+        return
+    if _events_ctx.pending is not None:
+        _events_ctx.pending.extend(events)
+        return
+    _events_ctx.pending = events
+    db.after_rollback(_discard_events)
+    db.after_commit(_flush_events)
+
+def _select_for_update(cls, names, where, *args):
+    '''
+    Return {primary key: instance} of rows of where clause with fields of names, locked until the
+    transaction ends, so values before a change can be compared with values after it.
+    '''
+    pk = cls.__primary_key__.name
+    names = [pk] + [k for k in names if k != pk]
+    rows = db.select_rows('select %s from `%s` %s for update' % (','.join(['`%s`' % k for k in names]), cls.__table__, where), *args)
+    return dict([(m[pk], m) for m in _build_hydrator(cls, names)(cls, rows)])
+
+def _publish_updated(cls, old, new, names):
+    '''
+    Queue post_update event of a row with the fields of names whose values differ between old and new,
+    and the version field which is increased by every update.
+    '''
+    pk = cls.__primary_key__.name
+    fields = tuple([k for k in names if old[k] != new[k]])
+    if cls.__version__ and not cls.__version__ in fields:
+        fields = fields + (cls.__version__,)
+    if fields:
+        _publish('post_update', cls, (old[pk],), fields)
+
+def _discard_events():
+    _events_ctx.pending = None
+
+def _flush_events():
+    events = _events_ctx.pending
+    _events_ctx.pending = None
+    if not events:
+        return
+    for name in _events:
+        for s in list(_subscribers[name]):
+            L = [e for e in events if e.name == name and s.wants(e.model)]
+            if not L:
+                continue
+            if s.batch:
+                _call_subscriber(s, L)
+            else:
+                for e in L:
+                    _call_subscriber(s, e)
+
+_background_queue = Queue.Queue(maxsize=10000)
+_background_lock = threading.Lock()
+_background_thread = []
+
+def _background_worker():
+    while True:
+        fn, arg = _background_queue.get()
+        try:
+            fn(arg)
+        except Exception, e:
+            logging.exception(e)
+
+def _call_subscriber(s, arg):
+    if not s.background:
+        try:
+            s.fn(arg)
+        except Exception, e:
+            logging.exception(e)
+        return
+    if not _background_thread:
+        with _background_lock:
+            if not _background_thread:
+                t = threading.Thread(target=_background_worker, name='model-events')
+                t.daemon = True
+                t.start()
+                _background_thread.append(t)
+    try:
+        _background_queue.put_nowait((s.fn, arg))
+    except Queue.Full:
+        logging.warning('Model event queue is full, drop event: %s' % arg)
+
 class ModelMetaclass(type):
     '''
     Metaclass for model objects.
     '''
     def __new__(cls, name, bases, attrs):
         # skip base Model class ClassName(object):
-        if name == 'Model':
+        if name in ('Model', 'CompactModel'):
             return type.__new__(cls, name, bases, attrs)
         if not hasattr(cls, 'subclass'):
             cls.subclass = {}
@@ -136,6 +1065,8 @@ class ModelMetaclass(type):
             if not v.name:
                 v.name = k
             logging.info('Found mapping %s=>%s' % (k, v))
+            if v.compress and not isinstance(v, (TextField, BlobField)):
+                raise TypeError('Only TextField and BlobField can be compressed: %s.%s' % (name, k))
             if v.primary_key:
                 if primary_key:
                     raise TypeError('Cannot define more than 1 primary key in class %s' % name)
@@ -154,33 +1085,299 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self:_gen_sql(attrs['__table__'], mappings)
+        attrs['__indexes__'] = _build_indexes(mappings, attrs.get('__indexes__', ()))
+        attrs['__sql__'] = lambda self:_gen_sql(attrs['__table__'], mappings, attrs['__indexes__'])
+        attrs.update(_compile_model(attrs['__table__'], mappings, primary_key))
+        counter = attrs.get('__counter__', None)
+        attrs['__counter__'] = _RowCounter(**counter) if isinstance(counter, dict) else None
+        cache = attrs.get('__cache__', None)
+        attrs['__cache__'] = _ModelCache(**cache) if isinstance(cache, dict) else None
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls, name, bases, attrs)
+        compact = not any([issubclass(b, dict) for b in bases])
+        if compact:
+            slots = set()
+            for b in bases:
+                for c in b.__mro__:
+                    slots.update(c.__dict__.get('__slots__', ()))
+            attrs['__slots__'] = tuple([k for k in attrs['__fields__'] if not k in slots])
+        klass = type.__new__(cls, name, bases, attrs)
+        if compact:
+            for k, f in mappings.iteritems():
+                if f.compress and k in klass.__dict__:
+                    setattr(klass, k, _CompressedSlot(klass.__dict__[k], f))
+        klass._hydrate = classmethod(_build_hydrator(klass, klass.__fields__))
+        klass.__codec__ = _Codec(klass)
+        cls.subclass[name] = klass
+        _register_counters(klass)
+        return klass
 
-class Model(dict):
-    __metaclass__ = ModelMetaclass
+class Query(object):
+    '''
+    Lazy and chainable query created by Model.query(). Each call returns a new Query, and SQL is
+    executed only when the query is iterated or sliced, or by count(), exists() and first().
 
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+    Iteration streams rows in batches. If the query has no offset and is ordered by one column (or not
+    ordered at all), batches are fetched by keyset pagination on (column, primary key), otherwise by
+    'limit offset, n'.
 
-    def __getattr__(self, key):
+    >>> class User(Model):
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField(nullable=False)
+    ...     password = StringField(nullable=False)
+    ...     email = StringField()
+    ...     last_modified = FloatField()
+    ... 
+    >>> q = User.query().where('id between ? and ?', 2001, 2099).order_by('id desc')
+    >>> q
+    Query(select `id`,`name`,`password`,`email`,`last_modified` from `user` where (id between ? and ?) order by `id` desc, args=[2001, 2099])
+    >>> n = User.query().where('id between ? and ?', 2001, 2099).delete()
+    >>> User.insert_many([User(id=n, name='u%s' % n, password='pwd') for n in range(2001, 2006)])
+    5
+    >>> [u.id for u in q.batch(2)]
+    [2005, 2004, 2003, 2002, 2001]
+    >>> [u.id for u in q[1:3]]
+    [2004, 2003]
+    >>> q.count(), q.limit(2).count(), q.exists(), q.first().id
+    (5, 2, True, 2005)
+    >>> [sorted(u.keys()) for u in q.only('name').limit(1)]
+    [['id', 'name']]
+    >>> q.where('name=?', 'nobody').exists()
+    False
+    '''
+    def __init__(self, cls):
+        self._cls = cls
+        self._where = []
+        self._args = []
+        self._order_by = ''
+        self._limit = None
+        self._offset = 0
+        self._fields = None
+        self._batch_size = 500
+
+    def _clone(self):
+        q = Query(self._cls)
+        q.__dict__.update(self.__dict__)
+        q._where = list(self._where)
+        q._args = list(self._args)
+        return q
+
+    def where(self, clause, *args):
+        '''
+        Add where clause like 'blog_id=?'. Clauses of multiple calls are joined by 'and'.
+        '''
+        q = self._clone()
+        m = _RE_WHERE.match(clause)
+        q._where.append('(%s)' % (clause[m.end():] if m else clause))
+        q._args.extend(args)
+        return q
+
+    def order_by(self, clause):
+        q = self._clone()
+        q._order_by = clause
+        return q
+
+    def limit(self, n):
+        q = self._clone()
+        q._limit = n
+        return q
+
+    def offset(self, n):
+        q = self._clone()
+        q._offset = n
+        return q
+
+    def only(self, *fields):
+        '''
+        Select only the specified fields (and primary key). Other fields are not loaded.
+        '''
+        for k in fields:
+            if not k in self._cls.__mappings__:
+                raise ValueError('No such field: %s' % k)
+        q = self._clone()
+        q._fields = fields
+        return q
+
+    def batch(self, n):
+        '''
+        Set rows count fetched by each query when iterating.
+        '''
+        q = self._clone()
+        q._batch_size = n
+        return q
+
+    def _names(self, *required):
+        if self._fields is None:
+            return self._cls.__fields__
+        wanted = set(self._fields)
+        wanted.add(self._cls.__primary_key__.name)
+        wanted.update(required)
+        return [k for k in self._cls.__fields__ if k in wanted]
+
+    def _where_sql(self, extra=None):
+        L = self._where + ([extra] if extra else [])
+        return ' where %s' % ' and '.join(L) if L else ''
+
+    def _order_sql(self):
+        keyset = self._keyset()
+        if keyset is None:
+            return ' order by %s' % self._order_by
+        # break ties by primary key, so rows are in stable order across batches:
+        col, desc = keyset
+        pk = self._cls.__primary_key__.name
+        direction = 'desc' if desc else 'asc'
+        if col == pk:
+            return ' order by `%s` %s' % (pk, direction) if self._order_by else ''
+        return ' order by `%s` %s, `%s` %s' % (col, direction, pk, direction)
+
+    def _select_sql(self, names):
+        return 'select %s from `%s`' % (','.join(['`%s`' % k for k in names]), self._cls.__table__)
+
+    def _keyset(self):
+        pk = self._cls.__primary_key__.name
+        if not self._order_by:
+            return pk, False
         try:
-            if (not self.has_key(key)) and self.__mappings__.has_key(key):
-                self[key] = self.__mappings__[key].default
-            return self[key]
-        except Exception:
-            raise AttributeError('instance of class "%s" has no attribute "%s"' % 
-                (self.__class__.__name__, key))
+            return _parse_order_by(self._cls, self._order_by)
+        except ValueError:
+            return None
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    def _batches(self, names):
+        remaining = self._limit
+        keyset = None if self._offset else self._keyset()
+        select = self._select_sql(names)
+        pk = self._cls.__primary_key__.name
+        order = self._order_sql() or ' order by `%s` asc' % pk
+        if keyset is None:
+            offset = self._offset
+            while remaining is None or remaining > 0:
+                n = self._batch_size if remaining is None else min(self._batch_size, remaining)
+                rows = db.select_rows('%s%s%s limit ?,?' % (select, self._where_sql(), order),
+                    *(self._args + [offset, n]))
+                if rows:
+                    yield rows
+                if len(rows) < n:
+                    return
+                offset += n
+                if remaining is not None:
+                    remaining -= n
+            return
+        col, desc = keyset
+        col_pos, pk_pos = names.index(col), names.index(pk)
+        last = None
+        while remaining is None or remaining > 0:
+            n = self._batch_size if remaining is None else min(self._batch_size, remaining)
+            extra, args = None, []
+            if last is not None:
+                extra, args = _keyset_clause(col, pk, '<' if desc else '>', last[col_pos], last[pk_pos])
+            rows = db.select_rows('%s%s%s limit ?' % (select, self._where_sql(extra), order),
+                *(self._args + args + [n]))
+            if rows:
+                yield rows
+            if len(rows) < n:
+                return
+            last = rows[-1]
+            if remaining is not None:
+                remaining -= n
+
+    def __iter__(self):
+        keyset = self._keyset()
+        names = self._names(*(keyset[:1] if keyset else ()))
+        hydrate = _build_hydrator(self._cls, names)
+        for rows in self._batches(names):
+            for m in hydrate(self._cls, rows):
+                yield m
+
+    def all(self):
+        return list(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None or (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+                raise ValueError('Only non-negative slice without step is supported.')
+            start = key.start or 0
+            q = self.offset(self._offset + start)
+            if key.stop is not None:
+                n = max(key.stop - start, 0)
+                q._limit = n if self._limit is None else max(min(n, self._limit - start), 0)
+            elif self._limit is not None:
+                q._limit = max(self._limit - start, 0)
+            return q.all() if q._limit != 0 else []
+        if key < 0:
+            raise IndexError('Negative index is not supported.')
+        L = self[key:key + 1]
+        if not L:
+            raise IndexError('Query index out of range.')
+        return L[0]
+
+    def first(self):
+        '''
+        Return the first instance or None, selected by 'limit 1'.
+        '''
+        names = self._names()
+        rows = db.select_rows('%s%s%s limit ?,1' % (self._select_sql(names), self._where_sql(), self._order_sql()),
+            *(self._args + [self._offset]))
+        return _build_hydrator(self._cls, names)(self._cls, rows)[0] if rows else None
+
+    def exists(self):
+        '''
+        Return True if any row matches, selected by 'select 1 ... limit 1'.
+        '''
+        rows = db.select_rows('select 1 from `%s`%s limit ?,1' % (self._cls.__table__, self._where_sql()),
+            *(self._args + [self._offset]))
+        return len(rows) > 0
+
+    def count(self):
+        '''
+        Return exact row count by 'count(*)' without fetching rows, bypassing the approximate count
+        cache of count_all(). Limit and offset are respected.
+        '''
+        if self._limit is None and not self._offset:
+            return db.select_int('select count(*) from `%s`%s' % (self._cls.__table__, self._where_sql()), *self._args)
+        limit = self._limit if self._limit is not None else 18446744073709551615
+        return db.select_int('select count(*) from (select 1 from `%s`%s limit ?,?) as `q`' % \
+            (self._cls.__table__, self._where_sql()), *(self._args + [self._offset, limit]))
+
+    def _check_set_based(self):
+        if self._limit is not None or self._offset or self._order_by:
+            raise ValueError('Cannot update or delete query with order by, limit or offset.')
+
+    def update(self, **values):
+        '''
+        Update matched rows by Model.update_where(). Return affected row count.
+        '''
+        self._check_set_based()
+        return self._cls.update_where(values, self._where_sql().strip(), *self._args)
+
+    def delete(self):
+        '''
+        Delete matched rows by Model.delete_where(). Return deleted row count.
+        '''
+        self._check_set_based()
+        return self._cls.delete_where(self._where_sql().strip(), *self._args)
+
+    def __str__(self):
+        return 'Query(%s%s%s, args=%s)' % (self._select_sql(self._names()), self._where_sql(), self._order_sql(), self._args)
+
+    __repr__ = __str__
+
+class _ModelMixin(object):
+    '''
+    ORM operations shared by Model and CompactModel. Instances are only accessed by dict protocol.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def query(cls):
+        '''
+        Return a lazy Query of this model, e.g. Comment.query().where('blog_id=?', blog_id).order_by('created_at desc')
+        '''
+        return Query(cls)
 
     @classmethod
     def create_table(cls):
-        sql = _gen_sql(cls.__table__, cls.__mappings__)
+        sql = _gen_sql(cls.__table__, cls.__mappings__, cls.__indexes__)
         db.update(sql)
 
     @classmethod
@@ -216,8 +1413,183 @@ class Model(dict):
         1505
         >>> 
         '''
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        cache = cls.__cache__
+        if cache is not None:
+            row = cache.get(pk)
+            if row is not None:
+                return cls._hydrate([row])[0]
+        rows = db.select_rows(cls.__get_sql__, pk)
+        if not rows:
+            return None
+        # rows read in a transaction may be rolled back:
+        if cache is not None and not db.in_transaction():
+            cache.put(pk, rows[0])
+        return cls._hydrate(rows)[0]
+
+    @classmethod
+    def get_many(cls, pks):
+        '''
+        Get instances by primary keys with one query. Return list in the order of pks, and keys
+        not found are skipped. Cached rows are not queried again if model has __cache__ defined.
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ... 
+        >>> n = User.delete_where('where id between ? and ?', 1901, 1903)
+        >>> User.insert_many([User(id=n, name='u%s' % n, password='pwd') for n in (1901, 1903)])
+        2
+        >>> [u.id for u in User.get_many([1903, 1902, 1901])]
+        [1903, 1901]
+        '''
+        cache = cls.__cache__
+        found = {}
+        missing = []
+        for pk in pks:
+            row = cache.get(pk) if cache is not None else None
+            if row is None:
+                missing.append(pk)
+            else:
+                found[pk] = row
+        if missing:
+            pk_name = cls.__primary_key__.name
+            pos = cls.__fields__.index(pk_name)
+            sql = '%s where `%s` in (%s)' % (cls.__select_sql__, pk_name, ','.join(['?'] * len(missing)))
+            if db.in_transaction():
+                cache = None
+            for row in db.select_rows(sql, *missing):
+                found[row[pos]] = row
+                if cache is not None:
+                    cache.put(row[pos], row)
+        return cls._hydrate([found[pk] for pk in pks if pk in found])
+
+    @classmethod
+    def decode(cls, data):
+        '''
+        Return instance decoded from data made by encode(). Raise ValueError if data is invalid or is
+        encoded by another version of the model.
+        '''
+        return cls.__codec__.decode(data, False)[0]
+
+    @classmethod
+    def encode_many(cls, instances):
+        '''
+        Encode list of instances, e.g. items of a page, to compact binary data.
+        '''
+        return cls.__codec__.encode(instances, True)
+
+    @classmethod
+    def decode_many(cls, data):
+        '''
+        Return list of instances decoded from data made by encode_many().
+        '''
+        return cls.__codec__.decode(data, True)
+
+    def encode(self):
+        '''
+        Encode fields of the instance to compact binary data for caching, without class path or field
+        names. Values that are not fields are not encoded.
+        '''
+        return self.__codec__.encode((self,), False)
+
+    @classmethod
+    def cache_stats(cls):
+        '''
+        Return hit, miss and eviction stats of second-level cache, or None if model has no __cache__.
+        '''
+        return cls.__cache__.stats() if cls.__cache__ is not None else None
+
+    @classmethod
+    def compress_rows(cls, batch_size=200):
+        '''
+        Compress existing values of fields with compress=True, e.g. after compression is turned on for a
+        field and its column is changed to blob. Rows are read in primary key order by batches, and each
+        batch is written in one transaction. Return changed row count.
+        '''
+        names = [k for k in cls.__fields__ if cls.__mappings__[k].compress]
+        if not names:
+            return 0
+        pk = cls.__primary_key__.name
+        select = 'select %s from `%s`' % (','.join(['`%s`' % k for k in [pk] + names]), cls.__table__)
+        n = 0
+        last = None
+        while True:
+            if last is None:
+                rows = db.select_rows('%s order by `%s` limit ?' % (select, pk), batch_size)
+            else:
+                rows = db.select_rows('%s where `%s`>? order by `%s` limit ?' % (select, pk, pk), last, batch_size)
+            if not rows:
+                break
+            with db.transaction():
+                for row in rows:
+                    sets = []
+                    params = []
+                    for k, v in izip(names, row[1:]):
+                        if isinstance(v, bytearray):
+                            v = str(v)
+                        if v is None or v.startswith(_COMPRESSED):
+                            continue
+                        c = _compress_value(cls.__mappings__[k], v)
+                        if c.startswith(_COMPRESSED):
+                            sets.append('`%s`=?' % k)
+                            params.append(c)
+                    if sets:
+                        params.append(row[0])
+                        n += db.update('update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(sets), pk), *params)
+            last = rows[-1][0]
+        if n and cls.__cache__ is not None:
+            cls.__cache__.invalidate()
+        return n
+
+    @classmethod
+    def repair_counters(cls, keys=None):
+        '''
+        Recompute all CounterField of the model from the counted rows, by one statement for each counter.
+        Return changed row count.
+
+        Args:
+            keys: primary keys of rows to repair, default to all rows
+
+        >>> class Post(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     reply_count = CounterField(model='Reply', key='post_id')
+        ...
+        >>> class Reply(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     post_id = IntegerField()
+        ...
+        >>> n = db.update('drop table if exists post')
+        >>> n = db.update('drop table if exists reply')
+        >>> Post.create_table()
+        >>> Reply.create_table()
+        >>> Post(id=1).insert().reply_count
+        0
+        >>> Reply.insert_many([Reply(id=1, post_id=1), Reply(id=2, post_id=1)])
+        2
+        >>> Reply(id=3, post_id=1).insert().id
+        3
+        >>> Post.get(1).reply_count == 3
+        True
+        >>> Reply.delete_where('where id<?', 3)
+        2
+        >>> Post.get(1).reply_count == 1
+        True
+        >>> n = db.update('update post set reply_count=10')
+        >>> Post.repair_counters()
+        1
+        >>> Post.get(1).reply_count == 1
+        True
+        '''
+        n = 0
+        for k, f in cls.__mappings__.iteritems():
+            if isinstance(f, CounterField):
+                n += _recount(cls, k, keys)
+        if n and cls.__cache__ is not None:
+            cls.__cache__.invalidate()
+        return n
 
     @classmethod
     def find_first(cls, where, *args):
@@ -252,16 +1624,15 @@ class Model(dict):
         1401
         >>> 
         '''
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        L = cls._hydrate(db.select_rows('%s %s' % (cls.__select_sql__, where), *args))
+        return L[0] if L else None
 
     @classmethod
     def find_by(cls, where, *args):
         '''
         Find by where clause and return list.
         '''
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+        return cls._hydrate(db.select_rows('%s %s' % (cls.__select_sql__, where), *args))
        
     @classmethod
     def find_all(cls, *args):
@@ -296,13 +1667,98 @@ class Model(dict):
         [1301, 1302, 1303, 1304, 1305]
         >>> 
         '''
-        L = db.select('select * from %s' % cls.__table__)
-        return [cls(**d) for d in L]
+        return cls._hydrate(db.select_rows(cls.__select_sql__))
+
+    @classmethod
+    def find_page(cls, where='', *args, **kw):
+        '''
+        Find one page of records by keyset (cursor) pagination, using (order column, primary key) as
+        the sort key so no rows are scanned and skipped as 'limit offset, n' does.
+
+        Return (list, next_cursor, previous_cursor). Pass next_cursor as 'after' to get the next page,
+        previous_cursor as 'before' to get the previous one. A cursor is None if there are no more rows.
+
+        Args:
+            where: optional where clause, e.g. 'where blog_id=?'
+            order_by: single column and direction, default to 'created_at desc'
+            after: cursor that returned rows must follow
+            before: cursor that returned rows must precede
+            limit: page size, default to 10
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ... 
+        >>> n = db.update('delete from user')
+        >>> u1 = User(name='zkl', password='zkl234bob', email='zkl@163.com', last_modified=1.0)
+        >>> for n in range(1601, 1606):
+        ...     u1.id = n
+        ...     u1.insert().id
+        ... 
+        1601
+        1602
+        1603
+        1604
+        1605
+        >>> L, next_cursor, previous_cursor = User.find_page(order_by='last_modified desc', limit=2)
+        >>> [u.id for u in L], previous_cursor
+        ([1605, 1604], None)
+        >>> L, next_cursor, previous_cursor = User.find_page(order_by='last_modified desc', after=next_cursor, limit=2)
+        >>> [u.id for u in L]
+        [1603, 1602]
+        >>> L, next_cursor, previous_cursor = User.find_page(order_by='last_modified desc', before=previous_cursor, limit=2)
+        >>> [u.id for u in L], previous_cursor
+        ([1605, 1604], None)
+        '''
+        order_by = kw.pop('order_by', 'created_at desc')
+        after = kw.pop('after', None)
+        before = kw.pop('before', None)
+        limit = kw.pop('limit', 10)
+        if kw:
+            raise TypeError('Unexpected arguments: %s' % ', '.join(kw.keys()))
+        if after and before:
+            raise ValueError('Cannot use both after and before cursor.')
+        col, desc = _parse_order_by(cls, order_by)
+        pk = cls.__primary_key__.name
+        cursor = after or before
+        backward = bool(before)
+        L = []
+        params = list(args)
+        m = _RE_WHERE.match(where)
+        if m:
+            L.append('(%s)' % where[m.end():])
+        elif where.strip():
+            raise ValueError('Where clause must start with "where": %s' % where)
+        if cursor:
+            # rows 'after' the cursor are smaller when ordered desc, and it is reversed when going backward:
+            op = '<' if desc != backward else '>'
+            value, pk_value = _decode_cursor(cursor)
+            sql, keyset_args = _keyset_clause(col, pk, op, value, pk_value)
+            L.append(sql)
+            params.extend(keyset_args)
+        direction = 'desc' if desc != backward else 'asc'
+        sql = '%s %s order by `%s` %s, `%s` %s limit ?' % (cls.__select_sql__,
+            'where %s' % ' and '.join(L) if L else '', col, direction, pk, direction)
+        params.append(limit + 1)
+        rows = db.select_rows(sql, *params)
+        has_more = len(rows) > limit
+        items = cls._hydrate(rows[:limit])
+        if backward:
+            items.reverse()
+        first = _encode_cursor([items[0][col], items[0][pk]]) if items else None
+        last = _encode_cursor([items[-1][col], items[-1][pk]]) if items else None
+        if backward:
+            return items, last, first if has_more else None
+        return items, last if has_more else None, first if after else None
 
     @classmethod
-    def count_all(cls, *args):
+    def count_all(cls, exact=False):
         '''
-        return row count of all rows
+        return row count of all rows. If model has __counter__ defined, the maintained count is returned
+        unless exact is True.
 
         >>> class User(Model):
         ...     id = IntegerField(primary_key=True)
@@ -332,8 +1788,14 @@ class Model(dict):
         5
         >>> 
         '''
-        n = db.select_int('select count(%s) from %s' % (cls.__primary_key__.name, cls.__table__))
-        return n
+        fn_load = lambda: db.select_int(cls.__count_sql__)
+        if cls.__counter__ is None:
+            return fn_load()
+        if exact:
+            n = fn_load()
+            cls.__counter__.set('', n)
+            return n
+        return cls.__counter__.get('', fn_load)
 
     @classmethod
     def count_by(cls, where, *args):
@@ -367,7 +1829,307 @@ class Model(dict):
         5
         >>> 
         '''
-        n = db.select_int('select count(%s) from %s %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        fn_load = lambda: db.select_int('%s %s' % (cls.__count_sql__, where), *args)
+        if cls.__counter__ is None:
+            return fn_load()
+        return cls.__counter__.get((where, args), fn_load)
+
+    @classmethod
+    def find_by_page(cls, page_index, page_size=10, where='', *args, **kw):
+        '''
+        Find rows of page and total row count in one round trip. Return (total, list).
+
+        The page index is adjusted as apis.Page does: less than 1 means the first page and greater
+        than page count means the last page.
+
+        Args:
+            page_index: page index starts from 1
+            page_size: rows count of each page
+            where: optional where clause
+            order_by: optional order by clause, default to 'created_at desc'
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ... 
+        >>> n = db.update('delete from user')
+        >>> u1 = User(name='zkl', password='zkl234bob', email='zkl@163.com', last_modified=1.0)
+        >>> for n in range(1701, 1706):
+        ...     u1.id = n
+        ...     u1.insert().id
+        ... 
+        1701
+        1702
+        1703
+        1704
+        1705
+        >>> total, L = User.find_by_page(2, 2, order_by='id')
+        >>> total, [u.id for u in L]
+        (5, [1703, 1704])
+        >>> total, L = User.find_by_page(9, 2, 'where id>?', 1701, order_by='id')
+        >>> total, [u.id for u in L]
+        (4, [1704, 1705])
+        '''
+        order_by = kw.pop('order_by', 'created_at desc')
+        if kw:
+            raise TypeError('Unexpected arguments: %s' % ', '.join(kw.keys()))
+        page_index = max(page_index, 1)
+        if cls.__counter__ is not None:
+            # total comes from counter, so only the page is selected:
+            total = cls.count_by(where, *args) if where else cls.count_all()
+        else:
+            # total is the last column, which is ignored by hydration:
+            sql = 'select %s, (%s %s) as `__total__` from `%s` %s order by %s limit ?,?' % \
+                (cls.__columns_sql__, cls.__count_sql__, where, cls.__table__, where, order_by)
+            params = list(args) + list(args) + [page_size * (page_index - 1), page_size]
+            rows = db.select_rows(sql, *params)
+            if rows:
+                return rows[0][-1], cls._hydrate(rows)
+            # page is out of range or no rows at all:
+            if page_index == 1:
+                return 0, []
+            total = cls.count_by(where, *args)
+        page_count = total // page_size + (1 if total % page_size > 0 else 0)
+        page_index = max(min(page_index, page_count), 1)
+        rows = db.select_rows('%s %s order by %s limit ?,?' % (cls.__select_sql__, where, order_by),
+            *(list(args) + [page_size * (page_index - 1), page_size]))
+        return total, cls._hydrate(rows)
+
+    @classmethod
+    def insert_many(cls, instances, hooks=True, batch_size=500):
+        '''
+        Insert instances by multi-row insert statements in one transaction. Return inserted row count.
+
+        Args:
+            instances: list of model instances
+            hooks: call pre_insert() of each instance if True
+            batch_size: max rows of each insert statement
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ... 
+        >>> n = db.update('delete from user')
+        >>> User.insert_many([User(id=n, name='u%s' % n, password='pwd') for n in range(1801, 1806)])
+        5
+        >>> User.count_by('where id between 1801 and 1805')
+        5
+        '''
+        rows = []
+        for m in instances:
+            hooks and m.pre_insert and m.pre_insert()
+            row = []
+            for k, f in cls.__insert_fields__:
+                if not k in m:
+                    m[k] = f.default
+                row.append(m[k])
+            for i, f in cls.__insert_packers__:
+                row[i] = _compress_value(f, row[i])
+            rows.append(row)
+        if not rows:
+            return 0
+        n = 0
+        changes = _counter_deltas(cls, instances, 1)
+        with db.transaction():
+            for i in range(0, len(rows), batch_size):
+                sql, params = _multi_values(cls.__insert_sql__, rows[i:i + batch_size])
+                n += db.update(sql, *params)
+            _apply_counter_deltas(changes)
+            _publish('post_insert', cls, [m[cls.__primary_key__.name] for m in instances], cls.__insert_names__)
+        _evict_counters(changes)
+        if n and cls.__counter__ is not None:
+            cls.__counter__.incr(n)
+        if cls.__cache__ is not None:
+            pk = cls.__primary_key__.name
+            cls.__cache__.invalidate([m[pk] for m in instances])
+        return n
+
+    @classmethod
+    def update_where(cls, values, where, *args, **kw):
+        '''
+        Update all rows that satisfy the where clause by one statement. Return affected row count.
+
+        Args:
+            values: dict of field name and new value
+            where: where clause, e.g. 'where user_id=?'
+            hooks: call pre_update() on an instance built from values and update the fields it set too,
+                default to False
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ...     def pre_update(self):
+        ...             self.last_modified = time.time()
+        ... 
+        >>> User.update_where(dict(name='renamed'), 'where id between ? and ?', 1801, 1803, hooks=True)
+        3
+        >>> User.count_by('where name=?', 'renamed')
+        3
+        '''
+        hooks = kw.pop('hooks', False)
+        if kw:
+            raise TypeError('Unexpected arguments: %s' % ', '.join(kw.keys()))
+        _check_where(where)
+        if hooks and cls.pre_update:
+            values = _hooked_values(cls, values)
+        for klass, name, key in _counters.get(cls.__name__, ()):
+            if key in values:
+                raise ValueError('Field is counted by %s.%s and cannot be updated in bulk: %s' % (klass.__name__, name, key))
+        names = []
+        params = []
+        for k, v in values.iteritems():
+            f = cls.__mappings__.get(k)
+            if f is None or not f.updateable or f.primary_key:
+                raise ValueError('Field is not updateable: %s' % k)
+            names.append('`%s`=?' % k)
+            params.append(_compress_value(f, v) if f.compress else v)
+        if not names:
+            return 0
+        if cls.__version__:
+            names.append('`%s`=`%s`+1' % (cls.__version__, cls.__version__))
+        params.extend(args)
+        sql = 'update `%s` set %s %s' % (cls.__table__, ','.join(names), where)
+        if _subscribed('post_update', cls):
+            with db.transaction():
+                old = _select_for_update(cls, values.keys(), where, *args)
+                n = db.update(sql, *params)
+                for m in old.itervalues():
+                    _publish_updated(cls, m, values, values.keys())
+        else:
+            n = db.update(sql, *params)
+        if n and cls.__counter__ is not None:
+            # row count is not changed but cached counts of where clauses may be:
+            cls.__counter__.incr(0)
+        if n and cls.__cache__ is not None:
+            cls.__cache__.invalidate()
+        return n
+
+    @classmethod
+    def delete_where(cls, where, *args):
+        '''
+        Delete all rows that satisfy the where clause by one statement. Return deleted row count.
+        Note pre_delete() is not called since no instance is loaded.
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ... 
+        >>> n = db.update('delete from user where id between 1901 and 1903')
+        >>> User.insert_many([User(id=n, name='deleted', password='pwd') for n in range(1901, 1904)])
+        3
+        >>> User.delete_where('where name=?', 'deleted')
+        3
+        '''
+        _check_where(where)
+        if _counters.get(cls.__name__) or _subscribed('post_delete', cls):
+            with db.transaction():
+                changes = _deleted_counter_deltas(cls, where, args)
+                if _subscribed('post_delete', cls):
+                    pks = [r[0] for r in db.select_rows('select `%s` from `%s` %s for update' % (cls.__primary_key__.name, cls.__table__, where), *args)]
+                    _publish('post_delete', cls, pks, ())
+                n = db.update('delete from `%s` %s' % (cls.__table__, where), *args)
+                _apply_counter_deltas(changes)
+            _evict_counters(changes)
+        else:
+            n = db.update('delete from `%s` %s' % (cls.__table__, where), *args)
+        if n and cls.__counter__ is not None:
+            cls.__counter__.incr(-n)
+        if n and cls.__cache__ is not None:
+            cls.__cache__.invalidate()
+        return n
+
+    @classmethod
+    def upsert(cls, instances, update_fields=None, hooks=True, batch_size=500):
+        '''
+        Insert instances, or update the existing rows with the same primary or unique key, by
+        'insert ... on duplicate key update' statements in one transaction.
+        Return affected row count as MySQL reports: 1 for each inserted row and 2 for each updated row.
+
+        Args:
+            instances: list of model instances
+            update_fields: fields to update if row exists, default to all updateable fields
+            hooks: call pre_insert() of each instance if True
+            batch_size: max rows of each statement
+
+        post_update events of existing rows carry the changed fields of update_fields, and events of
+        other rows carry all inserted fields, since they may have updated a row of another unique key.
+
+        >>> class User(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField(nullable=False)
+        ...     password = StringField(nullable=False)
+        ...     email = StringField()
+        ...     last_modified = FloatField()
+        ... 
+        >>> User.upsert([User(id=1804, name='new name', password='pwd'), User(id=1806, name='u1806', password='pwd')])
+        3
+        >>> User.get(1804).name
+        u'new name'
+        '''
+        if update_fields is None:
+            update_fields = [k for k, f in cls.__update_fields__]
+        for k in update_fields:
+            f = cls.__mappings__.get(k)
+            if f is None or f.primary_key:
+                raise ValueError('Field is not updateable: %s' % k)
+        rows = []
+        for m in instances:
+            hooks and m.pre_insert and m.pre_insert()
+            row = []
+            for k, f in cls.__insert_fields__:
+                if not k in m:
+                    m[k] = f.default
+                row.append(m[k])
+            for i, f in cls.__insert_packers__:
+                row[i] = _compress_value(f, row[i])
+            rows.append(row)
+        if not rows:
+            return 0
+        pk = cls.__primary_key__.name
+        sets = ['`%s`=values(`%s`)' % (k, k) for k in update_fields or [pk]]
+        if cls.__version__ and update_fields:
+            sets.append('`%s`=`%s`+1' % (cls.__version__, cls.__version__))
+        suffix = ' on duplicate key update %s' % ','.join(sets)
+        n = 0
+        # cannot tell inserted rows from updated ones, so recount the referred rows:
+        changes = _counter_deltas(cls, instances, 0)
+        subscribed = _subscribed('post_update', cls)
+        with db.transaction():
+            if subscribed:
+                pks = [m[pk] for m in instances]
+                old = _select_for_update(cls, update_fields, 'where `%s` in (%s)' % (pk, ','.join(['?'] * len(pks))), *pks)
+            for i in range(0, len(rows), batch_size):
+                sql, params = _multi_values(cls.__insert_sql__, rows[i:i + batch_size])
+                n += db.update(sql + suffix, *params)
+            for klass, name, deltas in changes:
+                _recount(klass, name, deltas.keys())
+            if subscribed:
+                for m in instances:
+                    if m[pk] in old:
+                        if update_fields:
+                            _publish_updated(cls, old[m[pk]], m, update_fields)
+                    else:
+                        # inserted rows cannot be told from rows updated by other unique keys:
+                        _publish('post_update', cls, (m[pk],), cls.__insert_names__)
+        _evict_counters(changes)
+        if n and cls.__counter__ is not None:
+            # cannot tell inserted rows from updated ones, so reload count next time:
+            cls.__counter__.clear()
+        if n and cls.__cache__ is not None:
+            pk = cls.__primary_key__.name
+            cls.__cache__.invalidate([m[pk] for m in instances])
         return n
 
     def update(self):
@@ -393,25 +2155,61 @@ class Model(dict):
         'fal'
         >>> User.get(1006).name
         u'fal'
+        >>> class Doc(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     title = StringField()
+        ...     version = VersionField()
+        ...
+        >>> n = db.update('drop table if exists doc')
+        >>> Doc.create_table()
+        >>> d1 = Doc(id=1, title='draft').insert()
+        >>> d2 = Doc.get(1)
+        >>> d1.title = 'first'
+        >>> d1.update().version
+        1
+        >>> d2.title = 'second'
+        >>> d2.update()
+        Traceback (most recent call last):
+          ...
+        ConflictError: Doc 1 was changed since version 0.
         '''
         self.pre_update and self.pre_update()
-        L = []
         args = []
-        for k, v in self.__mappings__.iteritems():
-            if v.updateable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
-                L.append('%s=?' % k)
-                args.append(arg)
-
-        pk = self.__primary_key__.name        
-        args.append(getattr(self, pk))
-        db.update('update %s set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        for k, f in self.__update_fields__:
+            if not k in self:
+                self[k] = f.default
+            args.append(self[k])
+        for i, f in self.__update_packers__:
+            args[i] = _compress_value(f, args[i])
+        pk = self[self.__primary_key__.name]
+        args.append(pk)
+        version = self.__version__
+        if version:
+            if not version in self:
+                self[version] = 0
+            args.append(self[version])
+        if _subscribed('post_update', self.__class__):
+            with db.transaction():
+                old = _select_for_update(self.__class__, self.__update_names__, 'where `%s`=?' % self.__primary_key__.name, pk).get(pk)
+                n = self._update_row(args)
+                if n:
+                    _publish_updated(self.__class__, old, self, self.__update_names__)
+        else:
+            self._update_row(args)
         return self
 
+    def _update_row(self, args):
+        pk = self[self.__primary_key__.name]
+        n = db.update(self.__update_sql__, *args)
+        if self.__cache__ is not None:
+            self.__cache__.invalidate((pk,))
+        version = self.__version__
+        if version:
+            if not n:
+                raise ConflictError('%s %s was changed since version %s.' % (self.__class__.__name__, pk, self[version]))
+            self[version] += 1
+        return n
+
     def delete(self):
         '''
         delete current data entity from database
@@ -433,9 +2231,21 @@ class Model(dict):
         >>> u1.delete()
         '''
         self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        pk_value = getattr(self, pk)
-        db.update('delete from %s where %s=?' % (self.__table__, pk), pk_value)
+        pk = self[self.__primary_key__.name]
+        if _counters.get(self.__class__.__name__):
+            with db.transaction():
+                changes = _deleted_counter_deltas(self.__class__, 'where `%s`=?' % self.__primary_key__.name, (pk,))
+                n = db.update(self.__delete_sql__, pk)
+                _apply_counter_deltas(changes)
+                n and _publish('post_delete', self.__class__, (pk,), ())
+            _evict_counters(changes)
+        else:
+            n = db.update(self.__delete_sql__, pk)
+            n and _publish('post_delete', self.__class__, (pk,), ())
+        if self.__cache__ is not None:
+            self.__cache__.invalidate((pk,))
+        if n and self.__counter__ is not None:
+            self.__counter__.incr(-n)
 
     def insert(self):
         '''
@@ -457,16 +2267,205 @@ class Model(dict):
         1001
         >>> 
         '''
-        params = {}
         self.pre_insert and self.pre_insert()
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[k] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
+        args = []
+        for k, f in self.__insert_fields__:
+            if not k in self:
+                self[k] = f.default
+            args.append(self[k])
+        for i, f in self.__insert_packers__:
+            args[i] = _compress_value(f, args[i])
+        if _counters.get(self.__class__.__name__):
+            changes = _counter_deltas(self.__class__, [self], 1)
+            with db.transaction():
+                n = db.update(self.__insert_sql__, *args)
+                _apply_counter_deltas(changes)
+                n and _publish('post_insert', self.__class__, (self[self.__primary_key__.name],), self.__insert_names__)
+            _evict_counters(changes)
+        else:
+            n = db.update(self.__insert_sql__, *args)
+            n and _publish('post_insert', self.__class__, (self[self.__primary_key__.name],), self.__insert_names__)
+        if n and self.__counter__ is not None:
+            self.__counter__.incr(n)
+        if self.__cache__ is not None:
+            self.__cache__.invalidate((self[self.__primary_key__.name],))
         return self
 
+class Model(_ModelMixin, dict):
+    __metaclass__ = ModelMetaclass
+
+    def __init__(self, **kw):
+        super(Model, self).__init__(**kw)
+
+    def __getattr__(self, key):
+        try:
+            if (not self.has_key(key)) and self.__mappings__.has_key(key):
+                self[key] = self.__mappings__[key].default
+            return self[key]
+        except Exception:
+            raise AttributeError('instance of class "%s" has no attribute "%s"' % 
+                (self.__class__.__name__, key))
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+_object_getattr = object.__getattribute__
+_object_setattr = object.__setattr__
+
+class CompactModel(_ModelMixin):
+    '''
+    Model that stores fields in __slots__ instead of a dict, which takes a fraction of memory of Model
+    for listing pages and caches. Attributes that are not fields are kept in a dict created on demand.
+    It supports attribute access and the dict protocol Model supports, but is not a dict, so use
+    to_dict() to serialize it (apis.dumps does so).
+
+    >>> class Item(CompactModel):
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField(intern=True)
+    ... 
+    >>> i = Item(id=1)
+    >>> i.name, 'name' in i
+    ('', True)
+    >>> i.html = '<p>extra</p>'
+    >>> sorted(i.to_dict().items())
+    [('html', '<p>extra</p>'), ('id', 1), ('name', '')]
+    >>> i['id'] = 2
+    >>> i.id, i['html']
+    (2, '<p>extra</p>')
+    >>> [(m.id, m.name) for m in Item._hydrate([(3, u'a'), (4, u'a')])]
+    [(3, u'a'), (4, u'a')]
+    >>> i.nothing
+    Traceback (most recent call last):
+      ...
+    AttributeError: instance of class "Item" has no attribute "nothing"
+    '''
+    __metaclass__ = ModelMetaclass
+    __slots__ = ('_extra',)
+
+    def __init__(self, **kw):
+        for k, v in kw.iteritems():
+            self.__setattr__(k, v)
+
+    def __getattr__(self, key):
+        # called only if key is neither an assigned slot nor a class attribute:
+        f = self.__mappings__.get(key)
+        if f is not None:
+            v = f.default
+            _object_setattr(self, key, v)
+            return v
+        extra = self._extras()
+        if extra is not None and key in extra:
+            return extra[key]
+        raise AttributeError('instance of class "%s" has no attribute "%s"' % 
+            (self.__class__.__name__, key))
+
+    def __setattr__(self, key, value):
+        try:
+            _object_setattr(self, key, value)
+        except AttributeError:
+            extra = self._extras()
+            if extra is None:
+                extra = {}
+                _object_setattr(self, '_extra', extra)
+            extra[key] = value
+
+    def _extras(self):
+        try:
+            return _object_getattr(self, '_extra')
+        except AttributeError:
+            return None
+
+    def __getitem__(self, key):
+        if key in self.__mappings__:
+            try:
+                return _object_getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        extra = self._extras()
+        if extra is None or not key in extra:
+            raise KeyError(key)
+        return extra[key]
+
+    def __setitem__(self, key, value):
+        self.__setattr__(key, value)
+
+    def __delitem__(self, key):
+        if key in self.__mappings__:
+            try:
+                object.__delattr__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            extra = self._extras()
+            if extra is None or not key in extra:
+                raise KeyError(key)
+            del extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    has_key = __contains__
+
+    def iterkeys(self):
+        for k in self.__fields__:
+            try:
+                _object_getattr(self, k)
+                yield k
+            except AttributeError:
+                pass
+        extra = self._extras()
+        if extra:
+            for k in extra.keys():
+                yield k
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        for k in self.iterkeys():
+            yield k, self[k]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [v for k, v in self.iteritems()]
+
+    def pop(self, key, *default):
+        try:
+            v = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return v
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, CompactModel):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % (k, v) for k, v in self.iteritems()]))
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('root', 'jlg234bob', 'test')
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, ChoiceLoader, FileSystemBytecodeCache
 
-import logging, os, re, cgi, sys, datetime, functools, threading, urllib, traceback, types, mimetypes
+import logging, os, re, cgi, sys, time, datetime, functools, threading, urllib, traceback, types, mimetypes, socket, Queue
+import gc, signal, select, email.utils, zlib, hashlib
+from wsgiref.util import FileWrapper
+import SocketServer, BaseHTTPServer
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 __author__ = 'liguo'
 
 # thread local object to store request and response:
@@ -241,7 +249,7 @@ class HttpError(Exception):
     def header(self, name, value):
         if not hasattr(self, '_headers'):
             self._headers = [_HEADER_X_POWERED_BY]
-            self._headers.append((name, value))
+        self._headers.append((name, value))
 
     @property
     def headers(self):
@@ -554,6 +562,8 @@ class Route(object):
         self.is_static = _re_route.search(self.path) is None
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
+        # interceptors declared by @interceptors(), None for all interceptors of application:
+        self.interceptors = getattr(func, '__web_interceptors__', None)
         self.func = func
 
     def match(self, url):
@@ -575,35 +585,510 @@ class Route(object):
 
     __repr__ = __str__
 
-def _static_file_generator(fpath):
-    BLOCK_SIZE = 8192
+def _static_file_generator(fpath, start=0, length=None):
+    BLOCK_SIZE = 65536
     with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+        f.seek(start)
+        while length is None or length > 0:
+            block = f.read(BLOCK_SIZE if length is None else min(BLOCK_SIZE, length))
+            if not block:
+                break
+            if length is not None:
+                length -= len(block)
             yield block
-            block = f.read(BLOCK_SIZE)
+
+def _http_date(t):
+    '''
+    Format timestamp as http date.
+
+    >>> _http_date(0)
+    'Thu, 01 Jan 1970 00:00:00 GMT'
+    '''
+    return email.utils.formatdate(t, usegmt=True)
+
+def _parse_http_date(s):
+    '''
+    Parse http date to timestamp, return None if it is invalid.
+
+    >>> _parse_http_date('Thu, 01 Jan 1970 00:01:40 GMT')
+    100
+    >>> _parse_http_date('yesterday')
+    '''
+    t = email.utils.parsedate_tz(s) if s else None
+    return email.utils.mktime_tz(t) if t else None
+
+def _parse_ranges(value, size):
+    '''
+    Parse header Range to list of (first, last) bytes, return None if it is invalid, or [] if no range
+    is satisfiable.
+
+    >>> _parse_ranges('bytes=0-99', 1000)
+    [(0, 99)]
+    >>> _parse_ranges('bytes=-100, 990-', 1000)
+    [(900, 999), (990, 999)]
+    >>> _parse_ranges('bytes=500-2000', 1000)
+    [(500, 999)]
+    >>> _parse_ranges('bytes=1000-', 1000)
+    []
+    >>> _parse_ranges('bytes=9-1', 1000)
+    >>> _parse_ranges('items=0-1', 1000)
+    '''
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    L = []
+    for s in spec.split(','):
+        first, sep, last = s.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+            else:
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start < size and end >= start:
+            L.append((start, min(end, size - 1)))
+    return L
+
+def _accept_encodings(value):
+    '''
+    Return set of content codings accepted by header Accept-Encoding.
+
+    >>> sorted(_accept_encodings('gzip, deflate, br;q=0'))
+    ['deflate', 'gzip']
+    >>> sorted(_accept_encodings('br;q=1.0, identity; q=0.5'))
+    ['br', 'identity']
+    '''
+    S = set()
+    for s in value.split(','):
+        coding, _, params = s.partition(';')
+        q = params.replace(' ', '').lower()
+        if q.startswith('q=') and not q[2:].strip('0.'):
+            continue
+        S.add(coding.strip().lower())
+    return S
+
+# files worth compressing, fonts like woff are compressed already:
+_COMPRESSIBLE_EXTS = ('.css', '.js', '.html', '.txt', '.json', '.svg', '.map', '.eot', '.otf', '.ttf')
+
+def _gzip(data):
+    # gzip format without file name and time, so that the same file gets the same bytes:
+    c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+class _StaticAsset(object):
+    '''
+    File cached in memory with headers and variants of (content coding or None, body, etag), ordered by
+    preference.
+    '''
+    __slots__ = ('mtime', 'size', 'checked', 'digest', 'content_type', 'headers', 'variants')
+
+    def __init__(self, fpath, st, max_age):
+        with open(fpath, 'rb') as f:
+            data = f.read()
+        self.mtime = int(st.st_mtime)
+        self.size = st.st_size
+        self.checked = time.time()
+        self.digest = hashlib.md5(data).hexdigest()[:10]
+        fext = os.path.splitext(fpath)[1].lower()
+        self.content_type = mimetypes.types_map.get(fext, 'application/octet-stream')
+        etag = '%x-%x' % (self.mtime, self.size)
+        self.variants = []
+        if fext in _COMPRESSIBLE_EXTS:
+            if brotli is not None:
+                self._add_variant('br', brotli.compress(data), etag, len(data))
+            self._add_variant('gzip', _gzip(data), etag, len(data))
+        self.variants.append((None, data, '"%s"' % etag))
+        self.headers = [('Last-Modified', _http_date(st.st_mtime)), ('Cache-Control', 'public, max-age=%d' % max_age), ('Accept-Ranges', 'bytes')]
+        if len(self.variants) > 1:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+
+    def _add_variant(self, coding, body, etag, size):
+        # not worth a variant if it saves less than 10%:
+        if len(body) < size * 0.9:
+            self.variants.append((coding, body, '"%s-%s"' % (etag, coding)))
+
+def _file_digest(fpath):
+    md5 = hashlib.md5()
+    for block in _static_file_generator(fpath):
+        md5.update(block)
+    return md5.hexdigest()[:10]
+
+_CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
 
 class StaticFileRoute(object):
-    def __init__(self):
+    '''
+    Route serving files under path prefix from document root, without running interceptors. Responses
+    have validators for conditional requests, and support single and multiple byte ranges.
+
+    Files up to cache_size bytes are loaded into memory by load() when application starts, with gzip
+    and brotli variants chosen by Accept-Encoding, and reloaded when they are changed. Range requests of
+    them are served from disk.
+
+    load() also builds a manifest of content-hashed urls like '/static/css/awesome.0123456789.css',
+    which are served with Cache-Control immutable while the file has not changed.
+    '''
+    # more ranges are served as the whole file:
+    MAX_RANGES = 16
+
+    def __init__(self, prefix='/static/', max_age=3600, cache_size=262144):
+        self.path = prefix
         self.method = 'GET'
         self.is_static = False
-        self.route = re.compile(r'^/static/(.+)$')
+        self.interceptors = ()
+        self.max_age = max_age
+        self.cache_size = cache_size
+        # path like 'static/css/awesome.css' => _StaticAsset:
+        self._assets = {}
+        # path => (hashed path, mtime, size), and hashed path => path:
+        self._manifest = {}
+        self._hashed = {}
+        # path => hashed path of previous content:
+        self._previous = {}
+
+    def load(self, document_root):
+        '''
+        Load files under the prefix directory into memory, and build manifest of hashed urls.
+        '''
+        assets = {}
+        for dirpath, dirnames, filenames in os.walk(os.path.join(document_root, self.path.strip('/'))):
+            for name in filenames:
+                fpath = os.path.join(dirpath, name)
+                st = os.stat(fpath)
+                key = os.path.relpath(fpath, document_root).replace(os.sep, '/')
+                if st.st_size <= self.cache_size:
+                    asset = assets[key] = _StaticAsset(fpath, st, self.max_age)
+                    self._add_url(key, asset.digest, asset.mtime, asset.size)
+                else:
+                    self._add_url(key, _file_digest(fpath), int(st.st_mtime), st.st_size)
+        self._assets = assets
+        logging.info('Load %d static files of %s.' % (len(assets), self.path))
+
+    def _add_url(self, key, digest, mtime, size):
+        base, ext = os.path.splitext(key)
+        hashed = '%s.%s%s' % (base, digest, ext)
+        old = self._manifest.get(key)
+        self._manifest[key] = (hashed, mtime, size)
+        self._hashed[hashed] = key
+        if old is not None and old[0] != hashed:
+            # url of the previous content still works without immutable, but older ones are dropped:
+            stale = self._previous.get(key)
+            if stale is not None and stale != hashed:
+                self._hashed.pop(stale, None)
+            self._previous[key] = old[0]
+
+    def url(self, path):
+        '''
+        Return content-hashed url of path, or path if it is not a loaded file.
+        '''
+        entry = self._manifest.get(path[1:])
+        return '/' + entry[0] if entry else path
+
+    def _immutable(self, url_key, key, mtime, size):
+        return url_key != key and self._manifest.get(key) == (url_key, mtime, size)
 
     def match(self, url):
-        if url.startswith('/static/'):
+        if url.startswith(self.path):
             return (url[1:],)
         return None
 
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        key = self._hashed.get(args[0], args[0])
+        asset = self._assets.get(key)
+        if asset is not None:
+            asset = self._refresh(key, asset)
+        if asset is not None and not ctx.request.header('Range'):
+            return self._serve_asset(asset, self._immutable(args[0], key, asset.mtime, asset.size))
+        root = os.path.abspath(os.path.join(ctx.application.document_root, self.path.strip('/')))
+        fpath = os.path.abspath(os.path.join(ctx.application.document_root, key))
+        # refuse paths like /static/../config.py:
+        if not fpath.startswith(root + os.sep) or not os.path.isfile(fpath):
             raise notfound()
+        st = os.stat(fpath)
+        size = st.st_size
         fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        etag = '"%x-%x"' % (int(st.st_mtime), size)
+        last_modified = _http_date(st.st_mtime)
+        request, response = ctx.request, ctx.response
+        response.content_type = content_type
+        response.set_header('ETag', etag)
+        response.set_header('Last-Modified', last_modified)
+        if self._immutable(args[0], key, int(st.st_mtime), size):
+            response.set_header('Cache-Control', _CACHE_IMMUTABLE)
+        else:
+            response.set_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+        response.set_header('Accept-Ranges', 'bytes')
+        if self._not_modified(request, etag, int(st.st_mtime)):
+            response.status = 304
+            return []
+        ranges = None
+        value = request.header('Range')
+        if value and request.header('If-Range', etag) in (etag, last_modified):
+            ranges = _parse_ranges(value, size)
+        if ranges == []:
+            response.status = 416
+            response.set_header('Content-Range', 'bytes */%d' % size)
+            return []
+        if ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            response.set_header('Content-Length', str(end - start + 1))
+            return _static_file_generator(fpath, start, end - start + 1)
+        if ranges and len(ranges) <= self.MAX_RANGES:
+            return self._multipart(fpath, ranges, size, content_type)
+        response.set_header('Content-Length', str(size))
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(open(fpath, 'rb'), 65536)
         return _static_file_generator(fpath)
 
+    def _refresh(self, key, asset):
+        # check file at most once a second:
+        now = time.time()
+        if now - asset.checked < 1:
+            return asset
+        fpath = os.path.join(ctx.application.document_root, key)
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            self._assets.pop(key, None)
+            return None
+        if int(st.st_mtime) != asset.mtime or st.st_size != asset.size:
+            if st.st_size > self.cache_size:
+                self._assets.pop(key, None)
+                return None
+            asset = self._assets[key] = _StaticAsset(fpath, st, self.max_age)
+            self._add_url(key, asset.digest, asset.mtime, asset.size)
+        asset.checked = now
+        return asset
+
+    def _serve_asset(self, asset, immutable):
+        request, response = ctx.request, ctx.response
+        accepted = _accept_encodings(request.header('Accept-Encoding', u''))
+        for coding, body, etag in asset.variants:
+            if coding is None or coding in accepted:
+                break
+        response.content_type = asset.content_type
+        for name, value in asset.headers:
+            response.set_header(name, value)
+        if immutable:
+            response.set_header('Cache-Control', _CACHE_IMMUTABLE)
+        response.set_header('ETag', etag)
+        if coding:
+            response.set_header('Content-Encoding', coding)
+        if self._not_modified(request, etag, asset.mtime):
+            response.status = 304
+            return []
+        response.set_header('Content-Length', str(len(body)))
+        return [body]
+
+    def _not_modified(self, request, etag, mtime):
+        # If-None-Match takes precedence over If-Modified-Since:
+        value = request.header('If-None-Match')
+        if value is not None:
+            tags = [t.strip() for t in value.split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+        since = _parse_http_date(request.header('If-Modified-Since'))
+        return since is not None and mtime <= since
+
+    def _multipart(self, fpath, ranges, size, content_type):
+        boundary = os.urandom(12).encode('hex')
+        heads = ['--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, content_type, start, end, size) for start, end in ranges]
+        tail = '--%s--\r\n' % boundary
+        length = sum([len(h) + end - start + 3 for h, (start, end) in zip(heads, ranges)]) + len(tail)
+        response = ctx.response
+        response.status = 206
+        response.content_type = 'multipart/byteranges; boundary=%s' % boundary
+        response.set_header('Content-Length', str(length))
+
+        def _parts():
+            for h, (start, end) in zip(heads, ranges):
+                yield h
+                for block in _static_file_generator(fpath, start, end - start + 1):
+                    yield block
+                yield '\r\n'
+            yield tail
+        return _parts()
+
 _static_fileroute = StaticFileRoute()
 
+def static_url(path):
+    '''
+    Return content-hashed url of static file path like '/static/css/awesome.css', or path if it is not
+    a loaded file of application. Registered as a global function of Jinja2TemplateEngine.
+
+    >>> static_url('/static/css/awesome.css')
+    '/static/css/awesome.css'
+    '''
+    app = getattr(ctx, 'application', None)
+    for route in (app and app.get('static_routes')) or ():
+        if path.startswith(route.path):
+            return route.url(path)
+    return path
+
+class _RouteNode(object):
+    '''
+    Node of Router for a path segment.
+    '''
+    __slots__ = ('children', 'params', 'routes', 'prefixes')
+
+    def __init__(self):
+        # literal segment => node:
+        self.children = {}
+        # (regex or None for a plain ':name' segment, node) in order of adding:
+        self.params = []
+        # method => route at end of path:
+        self.routes = {}
+        # method => route matching any rest of path, like StaticFileRoute:
+        self.prefixes = {}
+
+class Router(object):
+    '''
+    Segment tree of routes built when application starts. Static paths are looked up by dict, others
+    walk the tree one segment at a time, trying literal segments before variable ones.
+
+    >>> @get('/blog/:id')
+    ... def blog(blog_id):
+    ...     return blog_id
+    ...
+    >>> @post('/api/blogs/:id/comments')
+    ... def comment(blog_id):
+    ...     return blog_id
+    ...
+    >>> @get('/api/blogs/:id/comments')
+    ... def comments(blog_id):
+    ...     return blog_id
+    ...
+    >>> @get('/api/blogs/:id-:page')
+    ... def page(blog_id, page):
+    ...     return page
+    ...
+    >>> @get('/api/blogs/new/comments')
+    ... def newest():
+    ...     return 'newest'
+    ...
+    >>> router = Router()
+    >>> for fn in (blog, comment, comments, page, newest):
+    ...     router.add(Route(fn))
+    ...
+    >>> router.add(_static_fileroute, prefix=True)
+    >>> router.match('GET', '/blog/:123')
+    (Route(dynamic, GET, path=/blog/:id), ('123',))
+    >>> router.match('POST', '/api/blogs/:123/comments')
+    (Route(dynamic, POST, path=/api/blogs/:id/comments), ('123',))
+    >>> router.match('GET', '/api/blogs/:123-:2')
+    (Route(dynamic, GET, path=/api/blogs/:id-:page), ('123', '2'))
+    >>> router.match('GET', '/api/blogs/new/comments')
+    (Route(static, GET, path=/api/blogs/new/comments), ())
+    >>> router.match('GET', '/static/css/app.css')[1]
+    ('static/css/app.css',)
+    >>> router.match('GET', '/blog/123')
+    Traceback (most recent call last):
+      ...
+    HttpError: 404 Not Found
+    >>> router.match('DELETE', '/api/blogs/:123/comments')
+    Traceback (most recent call last):
+      ...
+    HttpError: 405 Method Not Allowed
+    '''
+    def __init__(self):
+        # path => {method: route} of static routes:
+        self._static = {}
+        self._root = _RouteNode()
+
+    def add(self, route, prefix=False):
+        '''
+        Add route, or route matching any path starting with route.path if prefix is True.
+        '''
+        if route.is_static and not prefix:
+            self._static.setdefault(route.path, {})[route.method] = route
+            return
+        segs = route.path.split('/')
+        if prefix and segs[-1] == '':
+            segs.pop()
+        node = self._root
+        for seg in segs:
+            node = self._child(node, seg)
+        (node.prefixes if prefix else node.routes)[route.method] = route
+
+    def _child(self, node, seg):
+        if _re_route.search(seg) is None:
+            child = node.children.get(seg)
+            if child is None:
+                child = node.children[seg] = _RouteNode()
+            return child
+        m = _re_route.match(seg)
+        regex = None if m and m.end() == len(seg) else re.compile(_build_regex(seg))
+        for r, child in node.params:
+            if (r and r.pattern) == (regex and regex.pattern):
+                return child
+        child = _RouteNode()
+        node.params.append((regex, child))
+        return child
+
+    def match(self, method, path):
+        '''
+        Return (route, args) of route matching method and path, raise HttpError 405 with header Allow if
+        path matches routes of other methods only, or 404 if path matches no route.
+        '''
+        allowed = set()
+        routes = self._static.get(path)
+        if routes:
+            route = routes.get(method)
+            if route:
+                return route, ()
+            allowed.update(routes)
+        found = self._walk(self._root, path.split('/'), 0, (), method, allowed)
+        if found:
+            route, args = found
+            return route, (route.match(path) if args is None else args)
+        if allowed:
+            e = HttpError(405)
+            e.header('Allow', ', '.join(sorted(allowed)))
+            raise e
+        raise notfound()
+
+    def _walk(self, node, segs, i, args, method, allowed):
+        if i == len(segs):
+            route = node.routes.get(method)
+            if route:
+                return route, args
+            allowed.update(node.routes)
+            return None
+        seg = segs[i]
+        child = node.children.get(seg)
+        if child is not None:
+            found = self._walk(child, segs, i + 1, args, method, allowed)
+            if found:
+                return found
+        for regex, child in node.params:
+            if regex is None:
+                if len(seg) < 2 or seg[0] != ':':
+                    continue
+                found = self._walk(child, segs, i + 1, args + (seg[1:],), method, allowed)
+            else:
+                m = regex.match(seg)
+                if m is None:
+                    continue
+                found = self._walk(child, segs, i + 1, args + m.groups(), method, allowed)
+            if found:
+                return found
+        if node.prefixes:
+            route = node.prefixes.get(method)
+            if route:
+                # prefix routes get arguments from route.match(path):
+                return route, None
+            allowed.update(node.prefixes)
+        return None
+
 # def static_file_handler(fpath):
 #     args = _static_fileroute.match(fpath)
 #     if args:
@@ -632,6 +1117,8 @@ class Request(object):
     '''
     def __init__(self, environ):
         self._environ = environ
+        self._route = None
+        self._route_args = ()
 
     def _parse_input(self):
         def _convert(item):
@@ -839,6 +1326,17 @@ class Request(object):
         '''
         return urllib.unquote(self._environ.get('PATH_INFO', ''))
 
+    @property
+    def route(self):
+        '''
+        Get path of the route that handles the request, e.g. '/blog/:blog_id'. Return None before routing.
+
+        >>> r = Request({'PATH_INFO': '/blog/:001'})
+        >>> r.route is None
+        True
+        '''
+        return self._route
+
     @property
     def host(self):
         '''
@@ -1213,9 +1711,18 @@ class TemplateEngine(object):
     def call(self, path, model):
         return '<!-- override this method to render template -->'
 
+    def precompile(self):
+        '''
+        Prepare templates when application starts, override it if templates can be compiled ahead.
+        '''
+        pass
+
 class Jinja2TemplateEngine(TemplateEngine):
     '''
-    Render using jinja2 template engine
+    Render using jinja2 template engine. In production mode templates are never checked for changes,
+    and all of them are compiled by precompile() when application starts. Compiled code is cached in
+    cache_dir if given, or loaded from bundle made by compile_bundle() if it exists, which must be made
+    again when templates change.
 
     >>> temp1_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
     >>> engine = Jinja2TemplateEngine(temp1_path)
@@ -1224,16 +1731,48 @@ class Jinja2TemplateEngine(TemplateEngine):
     '<p>Hello, Liguo.</p><span>2014-06-01 10:11:12</span>'
     '''
 
-    def __init__(self, temp1_dir, **kw):
+    def __init__(self, temp1_dir, production=False, cache_dir=None, bundle=None, **kw):
         if not 'autoescape' in kw:
             kw['autoescape'] = True
-        self._env = Environment(loader=FileSystemLoader(temp1_dir), **kw)
+        if production:
+            kw['auto_reload'] = False
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            kw['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+        self._loader = FileSystemLoader(temp1_dir)
+        loader = self._loader
+        if bundle and os.path.exists(bundle):
+            loader = ChoiceLoader([ModuleLoader(bundle), self._loader])
+        self._env = Environment(loader=loader, **kw)
+        self._env.globals['static_url'] = static_url
+        self._production = production
+        # template name => template compiled by precompile():
+        self._templates = {}
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
+    def precompile(self):
+        '''
+        Compile all templates in production mode, after filters are added.
+        '''
+        if self._production:
+            for name in self._loader.list_templates():
+                self._templates[name] = self._env.get_template(name)
+            logging.info('Compiled %d templates.' % len(self._templates))
+
+    def compile_bundle(self, target, zip='deflated'):
+        '''
+        Compile all templates to target, a zip file or a directory if zip is None, after filters are added.
+        '''
+        self._env.compile_templates(target, zip=zip, ignore_errors=False)
+
     def __call__(self, path, model):
-        return self._env.get_template(path).render(**model).encode('utf-8')
+        t = self._templates.get(path)
+        if t is None:
+            t = self._env.get_template(path)
+        return t.render(**model).encode('utf-8')
 
 def _debug():
     return 'to implement!'
@@ -1310,6 +1849,27 @@ def interceptor(pattern=''):
         return func
     return _decorator
 
+def interceptors(*fns):
+    '''
+    A decorator declaring which interceptors run for a route in order, if they match the path too.
+    They need not be added to application. Routes without it run all interceptors of application,
+    and @interceptors() runs none.
+
+    >>> @interceptor('/')
+    ... def check_user(fn_next):
+    ...    return fn_next()
+    >>> @interceptors(check_user)
+    ... @get('/api/users')
+    ... def api_users():
+    ...    pass
+    >>> Route(api_users).interceptors == (check_user,)
+    True
+    '''
+    def _decorator(func):
+        func.__web_interceptors__ = fns
+        return func
+    return _decorator
+
 def _build_interceptor_fn(fn_interceptor, fn_next):
     def _wrapper():        
         if fn_interceptor.__interceptor__(ctx.request.path_info):
@@ -1391,6 +1951,501 @@ def _load_module(module_name):
     m = __import__(from_module, locals(), globals(), [import_module])
     return getattr(m, import_module)
 
+# SO_REUSEPORT of Linux 3.9+, not defined by socket of Python 2:
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+class _WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    HTTP/1.1 request handler of ThreadPoolServer, which serves requests of a connection until the
+    client closes it or keeps it idle longer than server.keep_alive seconds.
+    '''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Transwarp/1.0'
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = 1
+        self.parked = False
+        self._served = 0
+        self.handle_one_request()
+        while not self.close_connection and not self.server.stopping:
+            # bytes in the read buffer are pipelined requests which poll() cannot see:
+            if self.server.parking and self._buffered() == 0:
+                # wait for the next request in the poll thread of server instead of this worker:
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def _buffered(self):
+        '''
+        Return count of bytes read from socket but not consumed by rfile, or None if unknown since
+        rfile is not a socket._fileobject of CPython 2 which keeps them in _rbuf.
+        '''
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf.tell() if rbuf is not None and hasattr(rbuf, 'tell') else None
+
+    def handle_one_request(self):
+        server = self.server
+        try:
+            self.connection.settimeout(server.keep_alive if self._served else server.header_timeout)
+            self.raw_requestline = self.rfile.readline(65537)
+            if not self.raw_requestline:
+                self.close_connection = 1
+                return
+            self.connection.settimeout(server.header_timeout)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = self.request_version = self.command = ''
+                self.send_error(414)
+                return
+            if not self.parse_request():
+                return
+            self._served += 1
+            self._run_wsgi()
+            self.wfile.flush()
+            self.server.request_done()
+        except socket.timeout:
+            self.close_connection = 1
+        except socket.error:
+            self.close_connection = 1
+
+    def _read_body(self):
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.send_error(411)
+            return None
+        try:
+            length = int(self.headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400)
+            return None
+        if length > self.server.max_body:
+            self.send_error(413)
+            self.close_connection = 1
+            return None
+        self.connection.settimeout(self.server.body_timeout)
+        L = []
+        while length > 0:
+            data = self.rfile.read(min(length, 65536))
+            if not data:
+                raise socket.error('connection closed when reading body')
+            L.append(data)
+            length -= len(data)
+        return ''.join(L)
+
+    def _environ(self, body):
+        env = self.server.base_environ.copy()
+        path, _, query = self.path.partition('?')
+        env['REQUEST_METHOD'] = self.command
+        env['PATH_INFO'] = urllib.unquote(path)
+        env['QUERY_STRING'] = query
+        env['SERVER_PROTOCOL'] = self.request_version
+        env['REMOTE_ADDR'] = self.client_address[0]
+        env['wsgi.input'] = StringIO(body)
+        env['wsgi.errors'] = sys.stderr
+        for k, v in self.headers.items():
+            k = k.replace('-', '_').upper()
+            if k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                env[k] = v
+            else:
+                env['HTTP_' + k] = v
+        return env
+
+    def _run_wsgi(self):
+        body = self._read_body()
+        if body is None:
+            return
+        response = {}
+
+        def write(data):
+            if not 'sent' in response:
+                self._send_headers(response, None)
+            self._write(response, data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and 'sent' in response:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response['status'] = status
+            response['headers'] = headers
+            return write
+
+        result = self.server.app(self._environ(body), start_response)
+        try:
+            if isinstance(result, str):
+                result = [result]
+            if isinstance(result, (list, tuple)):
+                data = ''.join(result)
+                if not 'sent' in response:
+                    self._send_headers(response, len(data))
+                self._write(response, data)
+            else:
+                for data in result:
+                    if not 'sent' in response:
+                        self._send_headers(response, None)
+                    self._write(response, data)
+                if not 'sent' in response:
+                    self._send_headers(response, 0)
+            if response.get('chunked'):
+                self.wfile.write('0\r\n\r\n')
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def _send_headers(self, response, length):
+        status = response['status']
+        headers = [(k, v) for k, v in response['headers'] if k.lower() != 'connection']
+        names = set([k.lower() for k, v in headers])
+        if 'content-length' in names or status[:3] in ('204', '304'):
+            pass
+        elif length is not None:
+            headers.append(('Content-Length', str(length)))
+        elif self.request_version == 'HTTP/1.1':
+            headers.append(('Transfer-Encoding', 'chunked'))
+            response['chunked'] = True
+        else:
+            self.close_connection = 1
+        if not 'date' in names:
+            headers.append(('Date', self.date_time_string()))
+        if self.server.stopping:
+            self.close_connection = 1
+        if self.close_connection:
+            headers.append(('Connection', 'close'))
+        elif self.request_version != 'HTTP/1.1':
+            headers.append(('Connection', 'keep-alive'))
+        L = ['%s %s\r\n' % (self.protocol_version, status)]
+        L.extend(['%s: %s\r\n' % (k, v) for k, v in headers])
+        L.append('\r\n')
+        self.wfile.write(''.join(L))
+        response['sent'] = True
+        self.log_request(status.split(' ', 1)[0], length or '-')
+
+    def _write(self, response, data):
+        if not data:
+            return
+        if response.get('chunked'):
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info('%s - %s' % (self.client_address[0], format % args))
+
+class ThreadPoolServer(SocketServer.TCPServer):
+    '''
+    HTTP/1.1 server running a wsgi application by a bounded pool of worker threads. Accepted connections
+    wait in a queue of at most queue connections, and get 503 when the queue is full. Idle keep-alive
+    connections wait for their next request in one poll thread, so they do not hold worker threads.
+    Without select.poll, e.g. on Windows, a worker serves a connection until it is closed.
+
+    Args:
+    threads: number of worker threads.
+    queue: max connections waiting for a worker.
+    keep_alive: seconds to wait for the next request of a connection.
+    header_timeout: seconds to wait for data when reading request line and headers.
+    body_timeout: seconds to wait for data when reading request body.
+    max_body: max bytes of request body.
+    max_requests, max_rss: stop after serving max_requests requests, or when peak memory exceeds max_rss MB.
+    reuse_port: bind with SO_REUSEPORT so that servers of other processes can listen on the same port.
+    listener: listening socket to accept on instead of binding address.
+    '''
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, app, threads=16, queue=128, keep_alive=5, header_timeout=10, body_timeout=30, max_body=10485760,
+                 max_requests=0, max_rss=0, reuse_port=False, listener=None):
+        self.reuse_port = reuse_port
+        SocketServer.TCPServer.__init__(self, address, _WSGIRequestHandler, bind_and_activate=listener is None)
+        if listener is not None:
+            self.socket.close()
+            self.socket = listener
+            self.server_address = listener.getsockname()
+        self.app = app
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.requests = 0
+        self.stopping = False
+        self._lock = threading.Lock()
+        self.keep_alive = keep_alive
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_body = max_body
+        self.base_environ = {
+            'SERVER_NAME': socket.getfqdn(address[0]),
+            'SERVER_PORT': str(address[1]),
+            'SCRIPT_NAME': '',
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper
+        }
+        self._connections = Queue.Queue(queue)
+        for i in range(threads):
+            t = threading.Thread(target=self._work, name='transwarp-worker-%d' % i)
+            t.daemon = True
+            t.start()
+        self.parking = hasattr(select, 'poll')
+        if self.parking:
+            self._parked = Queue.Queue()
+            self._wakeup = os.pipe()
+            t = threading.Thread(target=self._poll, name='transwarp-poll')
+            t.daemon = True
+            t.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        SocketServer.TCPServer.server_bind(self)
+
+    def request_done(self):
+        with self._lock:
+            self.requests += 1
+            n = self.requests
+        if self.max_requests and n >= self.max_requests:
+            logging.info('Server %s served %d requests, stopping.' % (os.getpid(), n))
+            self.stop()
+        elif self.max_rss and _rss() > self.max_rss:
+            logging.info('Server %s uses more than %s MB, stopping.' % (os.getpid(), self.max_rss))
+            self.stop()
+
+    def stop(self):
+        '''
+        Stop accepting connections and close keep-alive connections after current requests, then
+        serve_forever() returns. Can be called by any thread or signal handler.
+        '''
+        if not self.stopping:
+            self.stopping = True
+            t = threading.Thread(target=self.shutdown)
+            t.daemon = True
+            t.start()
+            if self.parking:
+                os.write(self._wakeup[1], 'x')
+
+    def server_close(self):
+        if self.stopping:
+            # connections waiting in the backlog would be reset when the socket is closed:
+            self.socket.setblocking(0)
+            while True:
+                try:
+                    request, client_address = self.socket.accept()
+                except socket.error:
+                    break
+                request.setblocking(1)
+                self.process_request(request, client_address)
+        SocketServer.TCPServer.server_close(self)
+
+    def drain(self, timeout):
+        '''
+        Wait at most timeout seconds until accepted connections are served.
+        '''
+        t = threading.Thread(target=self._connections.join)
+        t.daemon = True
+        t.start()
+        t.join(timeout)
+
+    def process_request(self, request, client_address):
+        try:
+            self._connections.put_nowait((request, client_address))
+        except Queue.Full:
+            logging.warning('Reject connection of %s: queue is full.' % client_address[0])
+            try:
+                request.sendall('HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n')
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _work(self):
+        while True:
+            request, client_address = self._connections.get()
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if handler is not None and handler.parked and not self.stopping:
+                    self._parked.put((request, client_address))
+                    os.write(self._wakeup[1], 'x')
+                else:
+                    self.shutdown_request(request)
+                self._connections.task_done()
+
+    def _poll(self):
+        poller = select.poll()
+        poller.register(self._wakeup[0], select.POLLIN)
+        # fd => (request, client_address, time to close if no request comes):
+        idle = {}
+        swept = time.time()
+        while True:
+            try:
+                events = poller.poll(1000)
+            except select.error:
+                continue
+            for fd, event in events:
+                if fd == self._wakeup[0]:
+                    os.read(fd, 4096)
+                    while not self._parked.empty():
+                        request, client_address = self._parked.get()
+                        idle[request.fileno()] = (request, client_address, time.time() + self.keep_alive)
+                        poller.register(request, select.POLLIN)
+                    continue
+                poller.unregister(fd)
+                request, client_address, expires = idle.pop(fd)
+                # readable, or closed by client which the handler finds out:
+                self.process_request(request, client_address)
+            now = time.time()
+            if self.stopping or now - swept >= 1:
+                swept = now
+                for fd, (request, client_address, expires) in idle.items():
+                    if self.stopping or expires < now:
+                        poller.unregister(fd)
+                        del idle[fd]
+                        self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logging.exception('Error when serving %s:' % client_address[0])
+
+def _rss():
+    '''
+    Return peak resident memory of current process in MB.
+    '''
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on Mac OS X, KB on Linux:
+    return rss / 1048576.0 if sys.platform == 'darwin' else rss / 1024.0
+
+class Supervisor(object):
+    '''
+    Prefork supervisor running ThreadPoolServer in worker processes forked from the process that loaded
+    the application, so workers share its memory copy-on-write and use all cpu cores.
+
+    Workers accept on their own SO_REUSEPORT sockets, or on a socket of the supervisor if SO_REUSEPORT is
+    not supported. A worker stops accepting and exits after serving max_requests requests, or when its
+    memory exceeds max_rss MB, and the supervisor forks a new one. On SIGHUP the supervisor executes
+    itself again to load new code, forks new workers and then stops old workers gracefully. SIGTERM and
+    SIGINT stop all workers gracefully, killing those still busy after graceful_timeout seconds.
+
+    Args:
+    app: wsgi application.
+    address: (host, port) to listen.
+    workers: number of worker processes.
+    other arguments are passed to ThreadPoolServer.
+    '''
+    def __init__(self, app, address, workers, graceful_timeout=30, **kw):
+        self.app = app
+        self.address = address
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.kw = kw
+        self._pids = set()
+        self._listener = None
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        old_pids = [int(pid) for pid in os.environ.pop('TRANSWARP_WORKERS', '').split(',') if pid]
+        if _SO_REUSEPORT is None:
+            self._listener = self._listen(os.environ.pop('TRANSWARP_LISTENER', None))
+        # objects loaded so far are shared by workers, collect garbage once and keep gc off them:
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        logging.info('Supervisor %s starts %d workers at %s:%s...' % (os.getpid(), self.workers, self.address[0], self.address[1]))
+        for i in range(self.workers):
+            self._spawn()
+        # new workers are accepting, old workers of the last code can stop now:
+        for pid in old_pids:
+            self._kill(pid, signal.SIGTERM)
+        while not self._stopping:
+            self._reap()
+            if self._reload:
+                self._exec()
+            time.sleep(1)
+        self._stop()
+
+    def _listen(self, fd):
+        if fd:
+            return socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(self.address)
+        s.listen(ThreadPoolServer.request_queue_size)
+        return s
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._pids.add(pid)
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            server = ThreadPoolServer(self.address, self.app, reuse_port=self._listener is None, listener=self._listener, **self.kw)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            server.serve_forever()
+            server.server_close()
+            server.drain(self.graceful_timeout)
+        except Exception:
+            logging.exception('Worker %s failed:' % os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            if pid in self._pids:
+                self._pids.remove(pid)
+                if not self._stopping and not self._reload:
+                    logging.info('Worker %s exited with status %s, fork a new one.' % (pid, status))
+                    self._spawn()
+
+    def _exec(self):
+        logging.info('Supervisor %s reloads...' % os.getpid())
+        os.environ['TRANSWARP_WORKERS'] = ','.join([str(pid) for pid in self._pids])
+        if self._listener is not None:
+            os.environ['TRANSWARP_LISTENER'] = str(self._listener.fileno())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+    def _stop(self):
+        logging.info('Supervisor %s stops workers...' % os.getpid())
+        for pid in self._pids:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self._pids and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self._pids:
+            self._kill(pid, signal.SIGKILL)
+
 class WSGIApplication(object):
     
     def __init__(self, document_root=None, **kw):
@@ -1405,11 +2460,8 @@ class WSGIApplication(object):
         self._interceptors = []
         
         self._template_engine = None
-        self._get_static = {}
-        self._post_static = {}
-        
-        self._get_dynamic = []
-        self._post_dynamic = []
+        self._router = Router()
+        self._static_routes = []
         
     def _check_not_running(self):
         if self._running:
@@ -1437,60 +2489,74 @@ class WSGIApplication(object):
     def add_url(self, func):
         self._check_not_running()
         route = Route(func)
-        if route.is_static:
-            if route.method == 'GET':
-                self._get_static[route.path] = route
-            elif route.method == 'POST':
-                self._post_static[route.path] = route
-        else:
-            if route.method == 'GET':
-                self._get_dynamic.append(route)
-            elif route.method == 'POST':
-                self._post_dynamic.append(route)
+        self._router.add(route)
         logging.info('Add route: %s ' % str(route))
         
+    def add_static_prefix(self, prefix):
+        '''
+        Serve files under path prefix, like '/static/', from document root without interceptors.
+        '''
+        self._check_not_running()
+        route = StaticFileRoute(prefix)
+        self._static_routes.append(route)
+        self._router.add(route, prefix=True)
+
     def add_interceptor(self, func):
         self._check_not_running()
         self._interceptors.append(func)
         logging.info('Add interceptor: %s' % str(func))
         
-    def run(self, port=9009, host='127.0.0.1'):
-        from wsgiref.simple_server import make_server
+    def run(self, port=9009, host='127.0.0.1', threads=0, debug=None, workers=0, **kw):
+        '''
+        Run application by the single-threaded wsgiref server, or by ThreadPoolServer with other
+        arguments if threads > 0, in worker processes of a Supervisor if workers > 0. Debug defaults
+        to True for the wsgiref server only.
+        '''
         logging.info('Application (%s) will start at %s:%s...' % (self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
+        if workers:
+            Supervisor(self.get_wsgi_application(debug=bool(debug)), (host, port), workers, threads=threads or 1, **kw).run()
+            return
+        # recycling by max_requests and max_rss needs a supervisor to start the next server:
+        for k in ('max_requests', 'max_rss', 'graceful_timeout'):
+            kw.pop(k, None)
+        if not threads:
+            from wsgiref.simple_server import make_server
+            server = make_server(host, port, self.get_wsgi_application(debug=debug is None or debug))
+        else:
+            server = ThreadPoolServer((host, port), self.get_wsgi_application(debug=bool(debug)), threads=threads, **kw)
         server.serve_forever()
         
     def get_wsgi_application(self, debug=False):
         self._check_not_running()
         self._running = True
-        self._get_dynamic.append(_static_fileroute)
+        static = StaticFileRoute()
+        self._static_routes.append(static)
+        self._router.add(static, prefix=True)
+        if self._document_root:
+            for route in self._static_routes:
+                route.load(self._document_root)
         
-        _application = Dict(document_root=self._document_root)
+        if self._template_engine is not None:
+            self._template_engine.precompile()
+        _application = Dict(document_root=self._document_root, static_routes=self._static_routes)
         
-        def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            elif request_method == 'POST':
-                fn = self._post_static.get(path_info, None) 
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            raise badrequest()
-    
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+        # route => interceptor chain built on first match, or None if no interceptors run for it:
+        route_chains = {}
+
+        def fn_exec():
+            fn, args = self._router.match(ctx.request.request_method, ctx.request.path_info)
+            request = ctx.request
+            request._route = fn.path
+            request._route_args = args
+            if fn not in route_chains:
+                L = self._interceptors if fn.interceptors is None else fn.interceptors
+                # the chain is shared by requests, so it reads args of current request:
+                route_chains[fn] = _build_interceptor_chain(lambda: fn(*ctx.request._route_args), *L) if L else None
+            chain = route_chains[fn]
+            if chain is None:
+                # static files and routes declaring no interceptors:
+                return fn(*args)
+            return chain()
     
         def wsgi(env, start_response):
             ctx.application = _application
@@ -1507,18 +2573,21 @@ class WSGIApplication(object):
                 start_response(response.status, response.headers)
                 return r
             except RedirectError, e:
+                response.status = e.status
                 response.set_header('Location', e.location)
                 start_response(response.status, response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except HttpError, e:
+                response.status = e.status
+                for name, value in e.headers[1:]:
+                    response.set_header(name, value)
                 start_response(response.status, response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
                 logging.exception(e)
-                start_response(response.status, response.headers)
                 if not debug:
                     start_response('500 Internal Server Error', [])
-                    return ['<html><body><h1>500 Internal Server Error<']
+                    return ['<html><body><h1>500 Internal Server Error</h1></body></html>']
                 
                 exec_type, exec_value, exec_traceback = sys.exc_info()
                 fp = StringIO()
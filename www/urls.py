@@ -7,11 +7,14 @@ Test users
 
 __author__ = 'Liguo'
 
-import logging, os, re, hashlib, time, markdown2
+import logging, os, re, hashlib, time, threading, markdown2
 
-from apis import api, Page, APIError, APIPermissionError, APIResourceNotFoundError, APIValueError
+from apis import api, Page, CursorPage, APIError, APIPermissionError, APIResourceNotFoundError, APIValueError, \
+    APIConflictError
 from config import configs
 from models import User, Blog, Comment
+from transwarp import db
+from transwarp.orm import ConflictError
 from transwarp.web import get, post, view, ctx, interceptor, seeother, notfound,\
     redirect
 
@@ -47,6 +50,35 @@ def check_admin():
         return
     raise APIPermissionError('No permission')    
         
+_query_lock = threading.Lock()
+_query_metrics = {}
+
+@interceptor('/')
+def query_interceptor(fn_next):
+    '''
+    Count statements of each request, and check them against the query budget of the route.
+    '''
+    with db.query_stats() as stats:
+        ctx.request.query_stats = stats
+        try:
+            r = fn_next()
+        finally:
+            route = ctx.request.route or '(no route)'
+            with _query_lock:
+                m = _query_metrics.get(route)
+                if m is None:
+                    m = _query_metrics[route] = dict(requests=0, statements=0, max_statements=0, elapsed=0.0)
+                m['requests'] += 1
+                m['statements'] += stats.count
+                m['elapsed'] += stats.elapsed
+                if stats.count > m['max_statements']:
+                    # keep statements of the heaviest request for debugging:
+                    m['max_statements'] = stats.count
+                    m['heaviest'] = stats.summary()
+    q = configs.queries
+    stats.check(route, repeat=q.repeat, budget=q.routes.get(route, q.budget), strict=q.strict)
+    return r
+
 @interceptor('/')
 def user_interceptor(fn_next):
     logging.info('try to find user for session cookie...')
@@ -62,6 +94,10 @@ def user_interceptor(fn_next):
 
 @interceptor('/manage')
 def manage_interceptor(fn_next):
+    '''
+    Require an admin user for all pages under /manage. It is added to application, so that a new manage
+    page cannot be reachable by forgetting to declare it.
+    '''
     user = ctx.request.user
     if user and user.admin:
         return fn_next()
@@ -103,7 +139,7 @@ def manage_blogs_edit(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise notfound()
-    return dict(id=blog.id, name=blog.name, summary=blog.summary, content=blog.content, 
+    return dict(id=blog.id, name=blog.name, summary=blog.summary, content=blog.content, version=blog.version,
         action='/api/blogs/edit/:%s' % blog_id, redirect='/manage/blogs', user=ctx.request.user)
 
 @get('/manage')
@@ -137,13 +173,19 @@ def blog(blog_id):
  
 ## api functions
 
+@api
+@get('/api/debug/queries')
+def api_debug_queries():
+    check_admin()
+    with _query_lock:
+        routes = dict([(k, dict(v)) for k, v in _query_metrics.iteritems()])
+    return dict(routes=routes, current=ctx.request.query_stats.summary())
+
 @api
 @get('/api/users')
 def api_get_users():
     logging.info('api get users...')
-    user_count = User.count_all()
-    page = Page(user_count, _get_page_index())
-    users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    users, page = _get_models_by_page(User)
     for u in users:
         u.password = '*****'
     return dict(users=users, page=page)
@@ -187,8 +229,7 @@ def register_user():
         raise APIValueError('email')
     if not password or not _RE_MD5.match(password):
         raise APIValueError('password')
-    user = User.find_first('where email=?', email)
-    if user:
+    if User.query().where('email=?', email).exists():
         raise APIError('register:failed', 'email', 'Email is already in use')
     user = User(name=name, email=email, password=password, image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email).hexdigest())
     user.insert()
@@ -199,10 +240,37 @@ def register_user():
 
 
 def _get_blogs_by_page():
-    total = Blog.count_all()
-    page = Page(total, _get_page_index())
-    blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
-    return blogs, page
+    return _get_models_by_page(Blog)
+
+def _get_models_by_page(cls):
+    '''
+    Return (models, page) ordered by created_at desc. Use keyset pagination if request has
+    'after' or 'before' cursor, otherwise use page index.
+    '''
+    cursors = _get_page_cursors()
+    if cursors:
+        after, before = cursors
+        try:
+            models, next_cursor, previous_cursor = cls.find_page(order_by='created_at desc',
+                after=after, before=before, limit=_PAGE_SIZE)
+        except ValueError:
+            raise APIValueError('before' if before else 'after', 'invalid cursor')
+        return models, CursorPage(_PAGE_SIZE, next_cursor, previous_cursor)
+    page_index = _get_page_index()
+    total, models = cls.find_by_page(page_index, _PAGE_SIZE, order_by='created_at desc')
+    return models, Page(total, page_index, _PAGE_SIZE)
+
+_PAGE_SIZE = 10
+
+def _get_page_cursors():
+    '''
+    Return (after, before) cursors if query string has any of them (even empty for the first page), otherwise None.
+    '''
+    after = ctx.request.get('after')
+    before = ctx.request.get('before')
+    if after is None and before is None:
+        return None
+    return after or None, before or None
     
 def _get_page_index(): 
     try:
@@ -228,7 +296,7 @@ def api_get_blogs():
 @post('/api/blogs/edit/:blog_id')
 def api_edit_blog(blog_id):
     check_admin()
-    i = ctx.request.input(name='', summary='', content='')
+    i = ctx.request.input(name='', summary='', content='', version='')
     name = i.name.strip()
     summary = i.summary.strip()
     content = i.content.strip()
@@ -239,10 +307,22 @@ def api_edit_blog(blog_id):
     if not content:
         raise ValueError('content', 'content cannot be empty.')
     blog = Blog.get(blog_id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    # the version the editor loaded, so concurrent edits are not overwritten:
+    if not i.version:
+        raise APIConflictError('Blog', 'blog version is missing, please reload and edit again.')
+    try:
+        blog.version = int(i.version)
+    except ValueError:
+        raise APIValueError('version')
     blog.name = name
     blog.summary = summary
     blog.content = content
-    blog.update()
+    try:
+        blog.update()
+    except ConflictError:
+        raise APIConflictError('Blog', 'blog was modified by others, please reload and edit again.')
     return blog
 
 @api
@@ -284,9 +364,7 @@ def api_delete_comment(comment_id):
 @api
 @get('/api/comments')
 def api_get_comments():
-    total = Comment.count_all()
-    page = Page(total, _get_page_index())
-    comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    comments, page = _get_models_by_page(Comment)
     return dict(comments=comments, page=page)
                 
 @api
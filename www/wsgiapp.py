@@ -9,7 +9,7 @@ import os, models
 import time
 
 from config import configs
-from transwarp import db
+from transwarp import db, assets
 from transwarp.web import WSGIApplication, Jinja2TemplateEngine
 import urls
 
@@ -47,15 +47,25 @@ def _init_users():
 # init wsgi APP
 wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+# bundles are normally built by build_assets.py. Build all if configured, or missing ones like on a
+# fresh checkout, once in the parent process before static files are loaded and workers are forked:
+bundles = configs.assets.bundles
+if not configs.assets.build:
+    bundles = dict([(output, bundles[output]) for output in bundles \
+        if not os.path.isfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), output))])
+if bundles:
+    assets.build(os.path.dirname(os.path.abspath(__file__)), bundles)
+
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'), **configs.templates)
 template_engine.add_filter('datetime', datetime_filter)
 wsgi.template_engine = template_engine
 
 
 wsgi.add_module(urls)
+wsgi.add_interceptor(urls.query_interceptor)
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 
 if __name__ == '__main__':
 #     _init_users()
-    wsgi.run(9009)
\ No newline at end of file
+    wsgi.run(**configs.server)
\ No newline at end of file